@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# benchmark
+# Benchmarks the stages of reserve2osm on synthetic protected areas, and checks that the topology is unchanged
+# Usage: python benchmark.py [ --sizes 10,20,40 ] [ --seed N ] [ --jobs N ] [ --geojson <filename> ] [ --save-golden ]
+
+
+import json
+import sys
+import os
+import io
+import math
+import random
+import hashlib
+import tempfile
+import contextlib
+
+import reserve2osm
+
+
+sizes = [10, 20, 40]		# Number of grid cells along each side
+seed = 1				# Seed for random generator
+jobs = 1				# Number of processes (--jobs N)
+edge_nodes = 8			# Nodes along each shared border between grid cells
+coast_nodes = 200		# Nodes along coast for each grid cell of width
+cell_size = 0.01		# Degrees
+golden_filename = "benchmark_golden.json"  # Topology hashes of earlier runs, for each seed and size
+
+stages = ["build", "combine", "simplify", "write"]
+
+
+
+# Output message
+
+def message (line):
+
+	sys.stdout.write (line)
+	sys.stdout.flush()
+
+
+
+# Generate seeded synthetic geojson features for grid of n x n cells.
+# Includes adjacent polygons with shared borders, holes, islands in holes (multipolygons),
+# self-touching rings, rings starting along a border (giving ways to combine) and a long coast-like ring along the south side.
+
+def generate_features(n, seed):
+
+	generator = random.Random(seed)
+	x0, y0 = 10.0, 60.0
+	borders = {}  # Shared borders between grid corners
+
+	# Coordinates of grid corner
+
+	def corner(i, j):
+		return [ round(x0 + i * cell_size, 7), round(y0 + j * cell_size, 7) ]
+
+	# Jittered border line between two grid corners, with same nodes in both directions
+
+	def border(a, b):
+		key = (min(a, b), max(a, b))
+		if key not in borders:
+			start, end = corner(*key[0]), corner(*key[1])
+			line = [ start ]
+			for k in range(1, edge_nodes):
+				t = k / edge_nodes
+				offset = generator.uniform(-0.0002, 0.0002)
+				line.append([ round(start[0] + (end[0] - start[0]) * t + offset, 7), round(start[1] + (end[1] - start[1]) * t + offset, 7) ])
+			line.append(end)
+			borders[ key ] = line
+		line = borders[ key ]
+		return line if key[0] == a else line[::-1]
+
+	# Closed ring along borders of list of grid corners, starting at given node after first corner
+
+	def ring(corners, start=0):
+		line = []
+		for a, b in zip(corners, corners[1:] + corners[:1]):
+			line.extend(border(a, b)[:-1])
+		line = line[ start: ] + line[ :start ]
+		line.append(line[0])
+		return line
+
+	# Small square ring inside grid cell
+
+	def square(i, j, size):
+		x, y = x0 + (i + 0.3) * cell_size, y0 + (j + 0.3) * cell_size
+		line = [ [x, y], [x, y + size], [x + size, y + size], [x + size, y] ]
+		line = [ [ round(lon, 7), round(lat, 7) ] for lon, lat in line ]
+		return line + [ line[0] ]
+
+	features = []
+	used = set()
+
+	def add_feature(geometry_type, coordinates):
+		features.append({
+			'type': 'Feature',
+			'properties': { 'id': len(features) + 1, 'navn': "Area %i" % (len(features) + 1) },
+			'geometry': { 'type': geometry_type, 'coordinates': coordinates }
+		})
+
+	for i in range(n):
+		for j in range(n):
+			if (i, j) in used:
+				continue
+
+			kind = generator.random()
+			used.add((i, j))
+
+			if kind < 0.05 and i + 1 < n and j + 1 < n and not { (i + 1, j), (i, j + 1), (i + 1, j + 1) } & used:
+				# Two diagonal cells in one self-touching ring, and one polygon for each of the two other cells
+				used.update([ (i + 1, j), (i, j + 1), (i + 1, j + 1) ])
+				add_feature("Polygon", [ ring([ (i, j), (i + 1, j), (i + 1, j + 1), (i + 2, j + 1), (i + 2, j + 2),
+										(i + 1, j + 2), (i + 1, j + 1), (i, j + 1) ]) ])
+				add_feature("Polygon", [ ring([ (i + 1, j), (i + 2, j), (i + 2, j + 1), (i + 1, j + 1) ]) ])
+				add_feature("Polygon", [ ring([ (i, j + 1), (i + 1, j + 1), (i + 1, j + 2), (i, j + 2) ]) ])
+
+			elif kind < 0.2 and i + 1 < n and (i + 1, j) not in used:
+				# Two adjacent cells in one polygon
+				used.add((i + 1, j))
+				add_feature("Polygon", [ ring([ (i, j), (i + 1, j), (i + 2, j), (i + 2, j + 1), (i + 1, j + 1), (i, j + 1) ]) ])
+
+			elif kind < 0.35:
+				# Polygon with hole, and island in hole as part of multipolygon with a detached square
+				hole = square(i, j, 0.3 * cell_size)
+				add_feature("Polygon", [ ring([ (i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1) ]), hole ])
+				add_feature("MultiPolygon", [ [ hole[::-1] ], [ square(i + n + 1, j, 0.2 * cell_size) ] ])
+
+			else:
+				# Some rings start along a border instead of at a corner, which gives ways to combine
+				start = edge_nodes // 2 if (i + j) % 3 == 0 else 0
+				add_feature("Polygon", [ ring([ (i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1) ], start) ])
+
+	# Long coast-like ring south of grid, sharing the south borders of the grid cells
+
+	coast = [ corner(0, 0) ]
+	for k in range(1, coast_nodes * n):
+		t = k / (coast_nodes * n)
+		depth = 0.3 + 0.2 * math.sin(t * 40) + generator.uniform(0, 0.3)
+		coast.append([ round(x0 + t * n * cell_size, 7), round(y0 - depth * cell_size, 7) ])
+	coast.append(corner(n, 0))
+
+	line = []
+	for i in range(n, 0, -1):
+		line.extend(border((i, 0), (i - 1, 0))[:-1])
+	line.extend(coast)
+	add_feature("Polygon", [ line ])
+
+	return features
+
+
+
+# Produce topology hash which does not depend on element order or osm ids.
+# Ways are node key sequences with tags, and relations are tags with sorted members.
+
+def topology_hash(converter):
+
+	counts = { 'node': 0, 'way': 0, 'relation': 0 }
+	node_keys = {}
+	ways = {}
+	relations = []
+
+	for element in converter.osm_elements(counts):
+		if element[0] == "node":
+			node_keys[ element[1] ] = element[2]
+		elif element[0] == "way":
+			ways[ element[1] ] = element
+		else:
+			relations.append(element)
+
+	way_lines = {}
+	topology = []
+	for way_id, element in iter(ways.items()):
+		way_lines[ way_id ] = tuple(node_keys[ node_id ] for node_id in element[2])
+		topology.append(("way", way_lines[ way_id ], tuple(sorted(element[3]))))
+
+	for element in relations:
+		members = tuple(sorted((way_lines[ way_id ], role) for way_id, role in element[2]))
+		topology.append(("relation", members, tuple(sorted(element[3]))))
+
+	topology.sort()
+	return hashlib.sha1(repr(topology).encode("utf-8")).hexdigest()
+
+
+
+# Run all stages for features, with output to temporary file.
+# Returns converter with times of stages, number of nodes and topology hash.
+
+def run_stages(features):
+
+	converter = reserve2osm.Converter("benchmark.geojson", jobs)
+	converter.features = features
+	node_count = sum(len(ring) for feature in features for polygon in reserve2osm.feature_polygons(feature) for ring in polygon)
+
+	with tempfile.TemporaryDirectory() as folder:
+		with contextlib.redirect_stdout(io.StringIO()):  # No progress output
+			converter.build()
+			converter.combine()
+			converter.simplify()
+			converter.write(os.path.join(folder, "benchmark.osm"))
+
+	return (converter, node_count, topology_hash(converter))
+
+
+
+# Wall time of stage, or 0 if not run (simplify is done in build with --jobs)
+
+def stage_time(stages, stage):
+
+	return stages[ stage ]['wall_seconds'] if stage in stages else 0
+
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	# Options
+
+	if "--sizes" in sys.argv[:-1]:
+		sizes = [ int(size) for size in sys.argv[ sys.argv.index("--sizes") + 1 ].split(",") ]
+
+	if "--seed" in sys.argv[:-1]:
+		seed = int(sys.argv[ sys.argv.index("--seed") + 1 ])
+
+	if "--jobs" in sys.argv[:-1]:
+		jobs = int(sys.argv[ sys.argv.index("--jobs") + 1 ])
+
+	if "--geojson" in sys.argv[:-1]:
+		filename = sys.argv[ sys.argv.index("--geojson") + 1 ]
+		collection = { 'type': 'FeatureCollection', 'features': generate_features(sizes[-1], seed) }
+		file = open(filename, "w")
+		json.dump(collection, file)
+		file.close()
+		message ("Saved %i features to '%s'\n" % (len(collection['features']), filename))
+		sys.exit()
+
+	save_golden = "--save-golden" in sys.argv
+	golden_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), golden_filename)
+
+	golden = {}
+	if os.path.isfile(golden_filename):
+		file = open(golden_filename)
+		golden = json.load(file)
+		file.close()
+
+	# Benchmark each size
+
+	message ("\nBenchmark of reserve2osm v%s, seed %i, %i jobs, %s\n\n" % (reserve2osm.version, seed, jobs,
+				"NumPy" if reserve2osm.np is not None else "no NumPy"))
+	message ("%6s %9s %9s %9s" % ("Size", "Features", "Nodes", "Combined") + "".join(" %9s" % stage for stage in stages) + "  Topology\n")
+
+	results = []
+	changed = 0
+
+	for size in sizes:
+		features = generate_features(size, seed)
+		feature_count = len(features)
+		converter, node_count, topology = run_stages(features)
+		results.append((node_count, converter.stages))
+
+		key = "%i/%i" % (seed, size)
+		if save_golden:
+			golden[ key ] = topology
+			status = "saved"
+		elif key not in golden:
+			status = "no golden"
+		elif golden[ key ] == topology:
+			status = "OK"
+		else:
+			status = "CHANGED"
+			changed += 1
+
+		message ("%6i %9i %9i %9i" % (size, feature_count, node_count, converter.combined_count)
+					+ "".join(" %8.3fs" % stage_time(converter.stages, stage) for stage in stages) + "  %s\n" % status)
+
+	# Scaling exponent k for time ~ nodes^k, between smallest and largest size
+
+	if len(results) > 1:
+		message ("%36s" % "Scaling (nodes^k)")
+		for stage in stages:
+			time1 = stage_time(results[0][1], stage)
+			time2 = stage_time(results[-1][1], stage)
+			if time1 > 0 and time2 > 0:
+				message (" %9.2f" % (math.log(time2 / time1) / math.log(results[-1][0] / results[0][0])))
+			else:
+				message (" %9s" % "-")
+		message ("\n")
+
+	if save_golden:
+		file = open(golden_filename, "w")
+		json.dump(golden, file, indent=2, sort_keys=True)
+		file.write("\n")
+		file.close()
+		message ("\nSaved topology to '%s'\n" % golden_filename)
+
+	message ("\n")
+
+	if changed:
+		sys.exit("*** Topology changed for %i sizes\n" % changed)
@@ -12,10 +12,34 @@ import json
 import sys
 import copy
 import math
-import urllib.request
+import urllib.parse
+import os
+import hashlib
+import http.client
+import threading
 import time
-from datetime import datetime
-from xml.etree import ElementTree as ET
+import heapq
+from array import array
+import gzip
+import bz2
+import zlib
+import struct
+import xml.etree.ElementTree as ET
+import cProfile
+import pstats
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+try:
+	import numpy as np
+except ImportError:  # Pure Python simplification is used instead
+	np = None
+
+try:
+	import resource
+except ImportError:  # Peak memory is not measured (Windows)
+	resource = None
 
 
 version = "2.0.0"
@@ -25,7 +49,37 @@ geojson = False			# Output raw data in geojson file
 debug = False			# Add a few extra tags
 simplify = True 		# Simplify lines before output (less nodes)
 simplify_factor = 0.2	# For reducing number of nodes
+numpy_min_nodes = 50	# Simplify lines and spans with at least this number of nodes with NumPy, if installed
 max_load = 10000		# Max features to load (per 1000), for debugging
+jobs = 1				# Number of processes for simplifying ways (--jobs N)
+page_size = 1000		# Features per page when loading from REST server
+download_workers = 4	# Pages loaded concurrently
+download_retries = 5	# Retries for failed requests
+retry_delay = 1			# Seconds before first retry, doubled for each retry
+cache = True			# Keep downloaded pages in cache folder and revalidate them
+cache_folder = "naturbase_cache"  # Folder for cached pages
+offline = False			# Only use cached pages (--offline)
+incremental = False		# Only load features changed since last run into local feature store (--incremental)
+store_filename = "%s_features.sqlite"  # Local feature store for each data source
+checkpoint = False		# Save topology after building relations and after combining ways (--checkpoint, for --resume-from)
+stable_ids = False		# Derive negative osm ids from content instead of counting down (--stable-ids)
+progress_interval = 0.5	# Seconds between progress counts
+profile = False			# Profile each stage and time each feature and way in one process (--profile)
+profile_count = 20		# Number of slowest features, ways and functions in profile report
+
+checkpoint_format = b"reserve2osm checkpoint 1\n"  # Start of checkpoint files
+
+endpoints = {
+	'naturvern':	"https://kart.miljodirektoratet.no/arcgis/rest/services/vern/mapserver/0/",
+	'friluft':		"https://kart.miljodirektoratet.no/arcgis/rest/services/friluftsliv_statlig_sikra/mapserver/0/"
+}
+
+# Properties used by get_tags, loaded from REST server together with the object id
+out_fields = {
+	'naturvern':	["naturvernId", "navn", "offisieltNavn", "verneform", "verneplan", "iucn", "faktaark", "verneforskrift",
+					"vernedato", "forvaltningsmyndighet", "kommune"],
+	'friluft':		["friluftId", "faktaark", "omraadeNavn", "omraadeBeskrivelse"]
+}
 
 # Avoid merging the following protected areas which have messy boundaries
 no_merge_areas = [
@@ -33,6 +87,10 @@ no_merge_areas = [
 	"VV00001227"		# Bratthagen naturminne
 ] 
 
+http_connections = threading.local()  # Reused connections for each download thread
+progress_time = 0  # Time of last progress count
+progress_width = 0  # Characters of last progress count
+
 iucn_code = {
 	'IUCN_IA':		'1a',
 	'IUCN_IB':		'1b',
@@ -97,6 +155,73 @@ def message (line):
 
 
 
+# Output progress count, at most once per progress interval
+
+def progress (count):
+
+	global progress_time, progress_width
+
+	now = time.time()
+	if now - progress_time >= progress_interval:
+		progress_time = now
+		text = "%i " % count
+		progress_width = len(text)
+		message ("\r" + text)
+
+
+
+# Clear last progress count from line
+
+def clear_progress():
+
+	global progress_width
+
+	if progress_width:
+		message ("\r" + " " * progress_width + "\r")
+		progress_width = 0
+
+
+
+# Get CPU time of process and of its finished worker processes
+
+def cpu_time():
+
+	times = os.times()
+	return times.user + times.system + times.children_user + times.children_system
+
+
+
+# Get peak memory in MB of process and of its largest finished worker process so far, or None if not available.
+# The operating system only keeps the peak since the process started, so it never goes down between stages.
+
+def peak_memory():
+
+	if resource is None:
+		return (None, None)
+
+	scale = 1048576 if sys.platform == "darwin" else 1024  # Bytes or kilobytes
+	return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+			round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+
+
+# Pack longitude and latitude into one integer node key, quantized to 1e-7 degrees (int32 each).
+# Data is loaded with 7 decimals, so coordinates are unchanged.
+
+def node_key(lon, lat):
+
+	return round(lon * 10000000) << 32 | (round(lat * 10000000) + 0x80000000)
+
+
+
+# Unpack node key into (lon, lat) in degrees
+
+def node_coordinates(node):
+
+	return ((node >> 32) / 10000000, ((node & 0xFFFFFFFF) - 0x80000000) / 10000000)
+
+
+
 # Compute closest distance from point p3 to line segment [s1, s2].
 # Works for short distances.
 
@@ -175,9 +300,111 @@ def simplify_line(line, epsilon):
 
 
 
-# Produce tags based on properties from Naturbase (info)
+# Find node with largest distance from line between first and last node, in projected coordinates.
+# Same distance as line_distance. Returns (index, distance) of first node with largest distance.
+
+def farthest_node(x, y, first, last):
+
+	x1, y1, x2, y2 = x[first], y[first], x[last], y[last]
+	dx = x2 - x1
+	dy = y2 - y1
+	len_sq = dx*dx + dy*dy
+
+	dmax = 0.0
+	index = first
+	for i in range(first + 1, last):
+		x3, y3 = x[i], y[i]
+
+		if len_sq != 0:  # in case of zero length line
+			param = ((x3 - x1)*dx + (y3 - y1)*dy) / len_sq
+		else:
+			param = -1
+
+		if param < 0:
+			x4, y4 = x1, y1
+		elif param > 1:
+			x4, y4 = x2, y2
+		else:
+			x4 = x1 + param * dx
+			y4 = y1 + param * dy
+
+		d = 6371000 * math.sqrt( (x4 - x3)*(x4 - x3) + (y4 - y3)*(y4 - y3) )  # In meters
+		if d > dmax:
+			index = i
+			dmax = d
+
+	return (index, dmax)
+
+
+
+# Simplify line of node keys with NumPy, using the same Ramer-Douglas-Peucker method and distances as simplify_line.
+# Node keys are unpacked and projected once per line, and an explicit stack of spans is used instead of recursion.
+# Spans shorter than numpy_min_nodes are searched without NumPy, since each NumPy call has a fixed overhead.
+# Returns array of remaining node keys.
+
+def simplify_line_numpy(line, epsilon):
+
+	nodes = np.frombuffer(line, dtype=np.int64)
+
+	# Simplified reprojection of latitude, same as line_distance
+	y = np.radians(((nodes & 0xFFFFFFFF) - 0x80000000) / 10000000)
+	x = np.radians((nodes >> 32) / 10000000) * np.cos(y)
+	x_list = x.tolist()
+	y_list = y.tolist()
+
+	keep = np.zeros(len(line), dtype=bool)
+	keep[0] = True
+	keep[-1] = True
+	spans = [ (0, len(line) - 1) ]
+
+	while spans:
+		first, last = spans.pop()
+		if last - first < 2:
+			continue
+
+		if last - first < numpy_min_nodes:
+			index, dmax = farthest_node(x_list, y_list, first, last)
+			if dmax > 0 and dmax >= epsilon:
+				keep[ index ] = True
+				spans.append((first, index))
+				spans.append((index, last))
+			continue
+
+		x1, y1, x2, y2 = x[first], y[first], x[last], y[last]
+		x3 = x[first + 1 : last]
+		y3 = y[first + 1 : last]
+		dx = x2 - x1
+		dy = y2 - y1
+
+		dot = (x3 - x1)*dx + (y3 - y1)*dy
+		len_sq = dx*dx + dy*dy
 
-def get_tags(info):
+		if len_sq != 0:  # in case of zero length line
+			param = dot / len_sq
+		else:
+			param = np.full(len(x3), -1.0)
+
+		x4 = np.where(param < 0, x1, np.where(param > 1, x2, x1 + param * dx))
+		y4 = np.where(param < 0, y1, np.where(param > 1, y2, y1 + param * dy))
+
+		dist_x = x4 - x3
+		dist_y = y4 - y3
+		distance = 6371000 * np.sqrt( dist_x*dist_x + dist_y*dist_y )  # In meters
+
+		index = int(np.argmax(distance))  # First node with max distance
+		if distance[ index ] > 0 and distance[ index ] >= epsilon:
+			index += first + 1
+			keep[ index ] = True
+			spans.append((first, index))
+			spans.append((index, last))
+
+	return array("q", nodes[ keep ].tobytes())
+
+
+
+# Produce tags based on properties from Naturbase (info), with a few extra tags if debug
+
+def get_tags(info, datatype, debug=False):
 
 	tags = {}
 
@@ -301,544 +528,2315 @@ def get_tags(info):
 
 
 
-# Create member record
+# Member way of area, with role
 
-def get_member(way_ref, role):
+class Member:
 
-	member = {
-		'way_ref': way_ref,
-		'role': role			
-	}
-	return member
+	__slots__ = ("way_ref", "role")
 
+	def __init__(self, way_ref, role):
 
+		self.way_ref = way_ref
+		self.role = role
 
-# Create new way record, including bbox
 
-def create_way(line):
 
-	new_way = {
-		'line': line,
-		'bbox_min': [0,0],
-		'bbox_max': [0,0]
-	}
+# Protected area, with member ways and tags
 
-	for i in [0, 1]:
-		new_way['bbox_min'][i] = min(point[i] for point in line)
-		new_way['bbox_max'][i] = max(point[i] for point in line)
+class Area:
 
-	return new_way
+	__slots__ = ("members", "tags")
 
+	def __init__(self):
 
+		self.members = []
+		self.tags = {}
 
-# Decompose outer/inner polygon into way segments
 
-def process_polygon(ref, input_polygon, role):
 
-	polygon = [ (point[0], point[1]) for point in input_polygon ]
+# Way segment, member of one or more areas.
+# The set of nodes is a direction-independent key used for matching ways with polygon segments.
 
-	# Skip matching if blacklisted
+class Way:
 
-	if not split or ref in no_merge_areas:
-		ways.append(create_way(polygon))
-		areas[ref]['members'].append(get_member(len(ways) - 1, role))
-		ways[-1]['nomerge'] = True
-		return
+	__slots__ = ("line", "nodes", "parents", "nomerge", "delete")
 
-	# Build list of ways intersecting with polygon to speed up matching
+	def __init__(self, line, nodes=None):
 
-	input_way = create_way(polygon)
-	polygon_set = set(polygon)
-	near_ways = []
+		if nodes is None:
+			nodes = frozenset(line)
 
-	for way_ref, way in enumerate(ways):
-		if (way['bbox_max'][0] >= input_way['bbox_min'][0] and way['bbox_min'][0] <= input_way['bbox_max'][0]
-				and way['bbox_max'][1] >= input_way['bbox_min'][1] and way['bbox_min'][1] <= input_way['bbox_max'][1]
-				and "nomerge" not in way
-				and len(polygon_set.intersection(way['line'])) > 0):  # Even for one node (touching rings)
-			near_ways.append(way_ref)
+		self.line = line  # Array of node keys
+		self.nodes = nodes
+		self.parents = set()  # Areas using way
+		self.nomerge = False  # Not merged with other ways
+		self.delete = False  # Combined into other way, no output
 
-	# Create new way if no matching ways
 
-#	if not near_ways:
-#		ways.append(create_way(polygon))
-#		areas[ref]['members'].append(get_member(len(ways) - 1, role))
-#		return		
 
-	# Loop intersecting ways and split/match
+# Split line into segments at each junction node, keeping junctions at both ends of segments.
+# Returns list of segments with at least two nodes, each with its (frozen) set of nodes.
 
-	junctions = set()
-	match_ways = []
+def split_line(line, junctions):
 
-	for way_ref in near_ways:
-		way = ways[ way_ref ]
-		way_line = way['line']
-		way_set = set(way['line'])
+	segments = []
+	start = 0
 
-		# Quick exit for exact match
+	for i in range(1, len(line)):
+		if line[i] in junctions:
+			segment = line[start:i+1]
+			segments.append((segment, frozenset(segment)))
+			start = i
 
-		if way_set == polygon_set:
-			areas[ ref ]['members'].append(get_member(way_ref, role))
-			return
+	if start < len(line) - 1:
+		segment = line[start:]
+		segments.append((segment, frozenset(segment)))
+
+	return segments
 
-		# Discover junctions
 
-		for i in range(1, len(polygon) - 1):
-			if polygon[i] in way_set and (polygon[i-1] not in way_set or polygon[i+1] not in way_set):
-				junctions.add(polygon[i])
 
-		for i in range(1, len(way_line) - 1):
-			if way_line[i] in polygon_set and (way_line[i-1] not in polygon_set or way_line[i+1] not in polygon_set):
-				junctions.add(way_line[i])			
+# Get list of polygons of feature, each with one outer and multiple inner patches
 
-		if not junctions:
-			continue  # No match
+def feature_polygons(feature):
 
-		for i in [0,-1]:
-			junctions.add(polygon[i])
-			junctions.add(way_line[i])
+	if feature['geometry']['type'] == "MultiPolygon":
+		return feature['geometry']['coordinates']
+	else:
+		return [ feature['geometry']['coordinates'] ]
 
-		# Split way at each junction
 
-		way_refs = []
-		remaining_line = way_line.copy()
 
-		while remaining_line:
-			new_line = [ remaining_line.pop(0) ]
-			while remaining_line and remaining_line[0] not in junctions:
-				new_line.append(remaining_line.pop(0))
+# Resolve way ref through aliases from deleted ways to the way they were combined into.
+# Returns surviving way ref and merge count of the last alias step (0 if never combined).
 
-			if remaining_line:
-				new_line.append(remaining_line[0])
+def resolve_way(alias, way_ref):
 
-			if len(new_line) > 1 :
-				if not way_refs:
-					way['line'] = new_line
-					way_refs.append(way_ref)
+	if way_ref not in alias:
+		return (way_ref, 0)
+
+	path = []
+	while way_ref in alias:
+		path.append(way_ref)
+		way_ref, merge_count = alias[ way_ref ]
+
+	for alias_ref in path:  # Path compression
+		alias[ alias_ref ] = (way_ref, merge_count)
+
+	return (way_ref, merge_count)
+
+
+
+# Simplify batch of lines of node keys. Also used by worker processes.
+# NumPy is only used for long lines, since the overhead of each NumPy call is larger than the gain for short lines.
+
+def simplify_lines(lines, epsilon):
+
+	new_lines = []
+	for line in lines:
+		if np is not None and len(line) >= numpy_min_nodes:
+			new_lines.append(simplify_line_numpy(line, epsilon))
+		else:
+			nodes = [ node_coordinates(node) + (node,) for node in line ]  # (lon, lat, node key)
+			new_lines.append(array("q", [ node[2] for node in simplify_line(nodes, epsilon) ]))
+
+	return new_lines
+
+
+
+# Get cached response for url, or None if not in cache
+
+def read_cache(url):
+
+	cache_file = os.path.join(cache_folder, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+	if not os.path.isfile(cache_file):
+		return None
+
+	file = open(cache_file, encoding="utf-8")
+	cache_entry = json.load(file)
+	file.close()
+	return cache_entry
+
+
+
+# Save response for url in cache, including headers for conditional requests
+
+def write_cache(url, response, json_data):
+
+	cache_entry = {
+		'url': url,
+		'etag': response.getheader("ETag"),
+		'last_modified': response.getheader("Last-Modified"),
+		'data': json_data
+	}
+
+	os.makedirs(cache_folder, exist_ok=True)
+	cache_file = os.path.join(cache_folder, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+	file = open(cache_file + ".tmp", "w", encoding="utf-8")
+	json.dump(cache_entry, file, ensure_ascii=False)
+	file.close()
+	os.replace(cache_file + ".tmp", cache_file)  # Avoid partial cache files
+
+
+
+# Get JSON response from REST server.
+# One connection per thread and host is reused, and failed requests are retried with exponential backoff.
+# Cached responses are revalidated with conditional requests, or used directly in offline mode.
+# Responses to one-off queries which will not be repeated are not cached (cached=False).
+
+def get_json(url, cached=True, offline=False):
+
+	cache_entry = None
+	headers = {}
+
+	if cached or offline:
+		cache_entry = read_cache(url)
+
+	if offline:
+		if cache_entry is None:
+			sys.exit("\n*** '%s' not in cache for offline mode\n" % url)
+		return cache_entry['data']
+
+	if cache_entry is not None:
+		if cache_entry['etag']:
+			headers['If-None-Match'] = cache_entry['etag']
+		if cache_entry['last_modified']:
+			headers['If-Modified-Since'] = cache_entry['last_modified']
+
+	parts = urllib.parse.urlsplit(url)
+	if not hasattr(http_connections, "hosts"):
+		http_connections.hosts = {}
+	connections = http_connections.hosts
+
+	for attempt in range(download_retries + 1):
+		try:
+			if parts.netloc not in connections:
+				if parts.scheme == "https":
+					connections[ parts.netloc ] = http.client.HTTPSConnection(parts.netloc, timeout=120)
 				else:
-					ways.append(create_way(new_line))
-					way_refs.append(len(ways) - 1)
+					connections[ parts.netloc ] = http.client.HTTPConnection(parts.netloc, timeout=120)
 
-				if len(polygon_set.intersection(new_line)) > 1:
-					match_ways.append(way_refs[-1])
+			connections[ parts.netloc ].request("GET", parts.path + "?" + parts.query, headers=headers)
+			response = connections[ parts.netloc ].getresponse()
+			data = response.read()
 
-		# Update members which already refer to way
+			if response.status == 304 and cache_entry is not None:  # Not modified
+				return cache_entry['data']
+			if response.status != 200:
+				raise http.client.HTTPException("HTTP status %i" % response.status)
+			json_data = json.loads(data)
+			if "error" in json_data:
+				raise ValueError("Server error %s" % json_data['error'])
 
-		if len(way_refs) > 1:
-			for area in areas.values():
-				for i, member in enumerate(area['members']):
-					if member['way_ref'] == way_ref:
-						new_members = []
-						for member_ref in way_refs:
-							new_members.append(get_member(member_ref, member['role']))
-						area['members'][i:i+1] = new_members
-						break
+			if cached:
+				write_cache(url, response, json_data)
+			return json_data
 
-	# Add self-intersecting junctions for polygon
+		except (OSError, http.client.HTTPException, ValueError) as error:
+			if parts.netloc in connections:
+				connections[ parts.netloc ].close()
+				del connections[ parts.netloc ]
 
-	polygon_set = set([polygon[0], polygon[-1]])
-	for node in polygon[1:-1]:
-		if node in polygon_set:
-			junctions.add(node)
-		polygon_set.add(node)
+			if attempt == download_retries:
+				sys.exit("\n*** Failed to load '%s': %s\n" % (url, error))
 
-	# Split polygon at junctions
+			message ("\n\t*** %s, retrying\n" % error)
+			time.sleep(retry_delay * 2 ** attempt)
 
-	segments = []
-	remaining_line = polygon.copy()
 
-	while remaining_line:
-		new_line = [ remaining_line.pop(0) ]
-		while remaining_line and remaining_line[0] not in junctions:
-			new_line.append(remaining_line.pop(0))
 
-		if remaining_line:
-			new_line.append(remaining_line[0])
+# Load page of features from REST server, starting at offset.
+# Continues with next part of page if the server returns fewer features than requested.
 
-		if len(new_line) > 1 and not(len(new_line) == 2 and new_line[0] == new_line[-1]):
-			segments.append(new_line)
+def load_page(url, offset, cached=True, offline=False):
 
-	# Match polygon segments with ways, or create new ways if no match
+	page_features = []
+	page_data = { 'exceededTransferLimit': True }
 
-	way_refs = []
-	for segment in segments:
-		found = False
-		for way_ref in match_ways:
-			if set(segment) == set(ways[ way_ref ]['line']):
-				areas[ ref ]['members'].append(get_member(way_ref, role))
-				match_ways.remove(way_ref)
-				found = True
-				break
+	while "exceededTransferLimit" in page_data and len(page_features) < page_size:
+		page_data = get_json(url + "&resultOffset=%i&resultRecordCount=%i" % (offset + len(page_features), page_size - len(page_features)), cached, offline)
+		if not page_data['features']:
+			break
+		page_features.extend(page_data['features'])
 
-		if not found:
-			ways.append(create_way(segment))
-			areas[ ref ]['members'].append(get_member(len(ways) - 1, role))
+	return page_features
 
 
 
-# Create data structure for feature and decompose line segments
+# Build query for REST server with where clause and optional bbox (min_lon, min_lat, max_lon, max_lat) in degrees
 
-def process_feature (feature):
+def query_url(where, bbox=None):
 
-	global ref_id
+	query = "query?where=" + urllib.parse.quote(where, safe="=")
+	if bbox:
+		query += "&geometry=%s&geometryType=esriGeometryEnvelope&inSR=4326&spatialRel=esriSpatialRelIntersects" \
+					% ",".join(str(value) for value in bbox)
 
-	info = feature['properties']
+	return query
 
-	if feature['geometry']['type'] == "MultiPolygon":
-		multipolygon = feature['geometry']['coordinates']
-	else:
-		multipolygon = [ feature['geometry']['coordinates'] ]
 
-	# Avoid small circles representing a point
 
-	coordinates = multipolygon[0][0]
-	if (len(coordinates) == 41
-			and coordinates[10][1] - coordinates[30][1] < 0.000180
-			and coordinates[10][1] - coordinates[30][1] > 0.000176):
-		return
+# Build where clause for REST server from where, kommune and verneform of selection
+
+def selection_where(selection):
+
+	conditions = []
+
+	if selection.get('where'):
+		conditions.append("(%s)" % selection['where'])
+
+	if selection.get('kommune'):  # Comma separated list of 4 digit numbers in kommune field
+		conditions.append("(%s)" % " OR ".join("kommune LIKE '%%%s%%'" % kommune.replace("'", "''") for kommune in selection['kommune']))
+
+	if selection.get('verneform'):
+		conditions.append("verneform IN (%s)" % ",".join("'%s'" % verneform.replace("'", "''") for verneform in selection['verneform']))
+
+	return " AND ".join(conditions) or "1=1"
 
-	# Init data structure.
-	# Areas may appear multiple times as geojson features, one for each outer area
 
-	if datatype == "geojson":
-		ref_id += 1
-		ref = ref_id
+
+# Load features matching where clause and optional bbox from REST server, with given fields or all fields.
+# Pages are loaded concurrently after getting the number of features.
+# Pages of one-off queries are not cached (cached=False).
+
+def load_query(endpoint, where, limit=None, bbox=None, fields=None, cached=True, offline=False):
+
+	query = query_url(where, bbox)
+	url = endpoint + query + "&outFields=%s&geometryPrecision=7&f=geojson" % (",".join(fields) if fields else "*")
+
+	count = get_json(endpoint + query + "&returnCountOnly=true&f=json", cached, offline)['count']
+	if limit is not None:
+		count = min(count, limit)
+	offsets = range(0, count, page_size)
+
+	query_features = []
+	with ThreadPoolExecutor(max_workers=download_workers) as pool:
+		for page_features in pool.map(load_page, [ url ] * len(offsets), offsets, [ cached ] * len(offsets), [ offline ] * len(offsets)):
+			query_features.extend(page_features)
+
+	return query_features
+
+
+
+# Encode geometry of feature as compact blob of int32 values, quantized to 1e-7 degrees like node keys.
+# Contains the number of polygons, and for each polygon the number of rings and the number of nodes of each ring.
+
+def encode_geometry(feature):
+
+	polygons = feature_polygons(feature)
+	data = array("i", [ feature['geometry']['type'] == "MultiPolygon", len(polygons) ])
+
+	for polygon in polygons:
+		data.append(len(polygon))
+		for ring in polygon:
+			data.append(len(ring))
+			for point in ring:
+				data.append(round(point[0] * 10000000))
+				data.append(round(point[1] * 10000000))
+
+	return data.tobytes()
+
+
+
+# Decode geometry blob from encode_geometry into geojson geometry
+
+def decode_geometry(blob):
+
+	data = array("i")
+	data.frombytes(blob)
+
+	i = 2
+	polygons = []
+	for p in range(data[1]):
+		polygon = []
+		ring_count = data[i]
+		i += 1
+		for r in range(ring_count):
+			node_count = data[i]
+			i += 1
+			polygon.append([ [ data[j] / 10000000, data[j + 1] / 10000000 ] for j in range(i, i + 2 * node_count, 2) ])
+			i += 2 * node_count
+		polygons.append(polygon)
+
+	if data[0]:
+		return { 'type': 'MultiPolygon', 'coordinates': polygons }
 	else:
-		ref = info[ datatype + 'Id' ]
+		return { 'type': 'Polygon', 'coordinates': polygons[0] }
+
+
+
+# Get Z-order (Morton) key of point, with 16 bits for each of longitude and latitude.
+# Features sorted by the key of their bbox centre are streamed in spatial order.
+# Ways depend on the order of features, so changing this key changes the output.
+
+def spatial_key(lon, lat):
+
+	x = min(int((lon + 180) / 360 * 65536), 65535)
+	y = min(int((lat + 90) / 180 * 65536), 65535)
+
+	key = 0
+	for bit in range(16):
+		key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+
+	return key
 
-	if ref not in areas:
-		areas[ ref ] = {
-			'members': [],
-			'tags': {}
-		}
-		if datatype == "geojson":
-			for key, value in iter(info.items()):
-				if value:
-					areas[ ref ]['tags'][ key ] = str(value)
-		else:
-			areas[ ref ]['tags'] = get_tags(info)
-			if ref in no_merge_areas:
-				areas[ ref ]['tags']['NOTE'] = "Polygonet er ikke flettet med andre verneområder"
 
-	# Create way segments for polygon/multipolygon.
-	# A multipolygon is a list of polygons, each with one outer and multiple inner patches
 
-	for polygon in multipolygon:
-		process_polygon (ref, polygon[0], "outer")
-		for inner in polygon[1:]:
-			process_polygon (ref, inner, "inner")
+# Open local feature store, creating tables and indexes if needed.
+# Features are stored with parsed properties as JSON, geometry blob and bbox in R*Tree index.
 
+def open_store(filename):
 
+	connection = sqlite3.connect(filename)
+	connection.executescript("""
+		CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT);
+		CREATE TABLE IF NOT EXISTS features (id INTEGER PRIMARY KEY, ref TEXT, verneform TEXT, spatial_key INTEGER,
+			properties TEXT, geometry BLOB);
+		CREATE TABLE IF NOT EXISTS feature_kommuner (kommune TEXT, id INTEGER);
+		CREATE VIRTUAL TABLE IF NOT EXISTS feature_bbox USING rtree (id, min_lon, max_lon, min_lat, max_lat);
+		CREATE INDEX IF NOT EXISTS features_spatial_key ON features (spatial_key);
+		CREATE INDEX IF NOT EXISTS features_verneform ON features (verneform);
+		CREATE INDEX IF NOT EXISTS feature_kommuner_kommune ON feature_kommuner (kommune);
+		CREATE INDEX IF NOT EXISTS feature_kommuner_id ON feature_kommuner (id);
+	""")
 
-# Combine non-branching ways into longer ways
+	return connection
+
+
+
+# Delete features with given object ids from feature store
+
+def delete_features(connection, object_ids):
+
+	for table in ["features", "feature_kommuner", "feature_bbox"]:
+		connection.executemany("DELETE FROM %s WHERE id = ?" % table, [ (object_id,) for object_id in object_ids ])
+
+
+
+# Insert or replace features in feature store, using object id from the REST server as id
+
+def upsert_features(connection, features, object_id_field, datatype):
+
+	delete_features(connection, [ feature['properties'][ object_id_field ] for feature in features ])
+
+	for feature in features:
+		info = feature['properties']
+		object_id = info[ object_id_field ]
+
+		outer_nodes = [ point for polygon in feature_polygons(feature) for point in polygon[0] ]
+		min_lon = min(point[0] for point in outer_nodes)
+		max_lon = max(point[0] for point in outer_nodes)
+		min_lat = min(point[1] for point in outer_nodes)
+		max_lat = max(point[1] for point in outer_nodes)
+
+		connection.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)",
+			(object_id, info.get(datatype + "Id"), info.get('verneform'), spatial_key((min_lon + max_lon) / 2, (min_lat + max_lat) / 2),
+			json.dumps(info, ensure_ascii=False), encode_geometry(feature)))
+		connection.execute("INSERT OR REPLACE INTO feature_bbox VALUES (?, ?, ?, ?, ?)", (object_id, min_lon, max_lon, min_lat, max_lat))
+
+		for kommune in (info.get('kommune') or "").split(","):
+			if kommune.strip():
+				connection.execute("INSERT INTO feature_kommuner VALUES (?, ?)", (kommune.strip(), object_id))
+
+
+
+# Build SQL query for selecting features from feature store in spatial order.
+# Selection is dict with optional bbox (min_lon, min_lat, max_lon, max_lat), list of kommune and list of verneform.
+# Returns (sql, parameters).
+
+def store_query(columns, selection):
+
+	selection = selection or {}
+	conditions = []
+	parameters = []
+
+	if selection.get('bbox'):
+		min_lon, min_lat, max_lon, max_lat = selection['bbox']
+		conditions.append("id IN (SELECT id FROM feature_bbox WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?)")
+		parameters.extend([ min_lon, max_lon, min_lat, max_lat ])
+
+	if selection.get('kommune'):
+		conditions.append("id IN (SELECT id FROM feature_kommuner WHERE kommune IN (%s))" % ",".join("?" * len(selection['kommune'])))
+		parameters.extend(selection['kommune'])
+
+	if selection.get('verneform'):
+		conditions.append("verneform IN (%s)" % ",".join("?" * len(selection['verneform'])))
+		parameters.extend(selection['verneform'])
+
+	sql = "SELECT %s FROM features" % columns
+	if conditions:
+		sql += " WHERE " + " AND ".join(conditions)
+	sql += " ORDER BY spatial_key, id"
+
+	return (sql, parameters)
+
+
+
+# Generator for selected features in feature store, in spatial order.
+# Only the geometry blob of each feature is decoded, one feature at a time.
+# Optional object ids are the features selected by the REST server.
+
+def store_features(filename, selection, object_ids=None):
+
+	connection = sqlite3.connect(filename)
+	sql, parameters = store_query("id, properties, geometry", selection)
+
+	for object_id, properties, geometry in connection.execute(sql, parameters):
+		if object_ids is not None and object_id not in object_ids:
+			continue
+		yield {
+			'type': 'Feature',
+			'properties': json.loads(properties),
+			'geometry': decode_geometry(geometry)
+		}
 
-def combine_ways():
+	connection.close()
 
-	# Build dict of junctions with set of all connected ways
 
-	junctions = {}
-	for way_ref, way in enumerate(ways):
-		way['parents'] = set()
-		if "nomerge" not in way:
-			for node in [ way['line'][0], way['line'][-1] ]:
-				if node not in junctions:
-					junctions[ node ] = []  # Set not used due to self-intersecting rings
-				junctions[ node ].append(way_ref)
 
-	# Build info on which areas uses each way
+# Hash and count selected features in feature store, in the same order as store_features, without decoding them
 
-	for area_ref, area in iter(areas.items()):
-		for member in area['members']:
-			ways[ member['way_ref'] ]['parents'].add(area_ref)
+def store_hash(filename, selection, input_hash, object_ids=None):
 
-	# Iterate junctions and combine if no branching (2 ways with identical parents)
+	connection = sqlite3.connect(filename)
+	sql, parameters = store_query("id, properties, geometry", selection)
 
 	count = 0
-	for node in junctions.keys():
-		junction = junctions[ node ]
+	for object_id, properties, geometry in connection.execute(sql, parameters):
+		if object_ids is not None and object_id not in object_ids:
+			continue
+		input_hash.update(properties.encode("utf-8"))
+		input_hash.update(geometry)
+		count += 1
 
-		if len(junction) == 2:
-			way_ref1 = list(junction)[0]
-			way_ref2 = list(junction)[1]
+	connection.close()
 
-			if way_ref1 != way_ref2 and ways[ way_ref1 ]['parents'] == ways[ way_ref2 ]['parents']:
-				line1 = ways[ way_ref1 ]['line']
-				line2 = ways[ way_ref2 ]['line']
+	return count
 
-				# Connect at node position, even for ring. Ways have same direction.
-				if line1[-1] == node:
-					new_line = line1 + line2[1:]  
+
+
+# Load features from REST server into the local feature store.
+# All features are loaded and updated, and features no longer on the server are deleted.
+# In incremental mode, only features changed since the last run are loaded. Edited features are found from
+# the edit date field of the layer, and deleted features from the current object ids.
+# Bbox, kommune, verneform and where of selection are included in the queries, so that only selected features are loaded.
+# Pages are cached if cache, and only cached pages are used if offline.
+# Returns set of object ids of selected features, or None if all features are selected.
+
+def update_store(endpoint, store_filename, datatype, selection, incremental=False, cache=True, offline=False):
+
+	run_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")  # Before queries to include edits during loading
+
+	id_data = get_json(endpoint + "query?where=1=1&returnIdsOnly=true&f=json", cache, offline)
+	object_id_field = id_data['objectIdFieldName']
+	object_ids = set(id_data['objectIds'])
+
+	fields = out_fields[ datatype ] + [ object_id_field ]
+	where = selection_where(selection)
+	bbox = selection.get('bbox')
+
+	selected_ids = None
+	if where != "1=1" or bbox:
+		id_data = get_json(endpoint + query_url(where, bbox) + "&returnIdsOnly=true&f=json", cache, offline)
+		selected_ids = set(id_data['objectIds'] or [])  # None if no features
+
+	connection = open_store(store_filename)
+	stored_ids = set(row[0] for row in connection.execute("SELECT id FROM features"))
+	timestamp = connection.execute("SELECT value FROM store_info WHERE key = 'timestamp'").fetchone()
+
+	edit_date_field = None
+	if incremental:
+		layer_data = get_json(endpoint + "?f=json", cache, offline)
+		if layer_data.get('editFieldsInfo'):
+			edit_date_field = layer_data['editFieldsInfo'].get('editDateField')
+
+	if incremental and timestamp and edit_date_field:
+		# Load edited and new features.
+		# These queries include the time of the last run or new object ids, so they are not cached.
+
+		changed_where = "%s > timestamp '%s'" % (edit_date_field, timestamp[0])
+		if where != "1=1":
+			changed_where = where + " AND " + changed_where
+
+		changed_features = load_query(endpoint, changed_where, bbox=bbox, fields=fields, cached=False, offline=offline)
+		changed_ids = set(feature['properties'][ object_id_field ] for feature in changed_features)
+		new_ids = sorted((object_ids if selected_ids is None else selected_ids) - stored_ids - changed_ids)
+
+		for i in range(0, len(new_ids), 500):
+			new_where = "%s IN (%s)" % (object_id_field, ",".join(str(object_id) for object_id in new_ids[i:i+500]))
+			changed_features.extend(load_query(endpoint, new_where, fields=fields, cached=False, offline=offline))
+
+	else:
+		if incremental and not edit_date_field:
+			message ("\n\t*** No edit date in layer, loading all features\n")
+
+		changed_features = load_query(endpoint, where, None if incremental else max_load, bbox, fields, cache, offline)
+
+	# Merge into feature store.
+	# Time of run is only saved when all features are selected, so that later runs load edits outside of selection.
+
+	deleted_ids = stored_ids - object_ids
+	with connection:
+		delete_features(connection, deleted_ids)
+		upsert_features(connection, changed_features, object_id_field, datatype)
+		if selected_ids is None:
+			connection.execute("INSERT OR REPLACE INTO store_info VALUES ('timestamp', ?)", (run_time,))
+	connection.close()
+
+	message (" %i loaded, %i deleted ..." % (len(changed_features), len(deleted_ids)))
+
+	return selected_ids
+
+
+
+# Generator for features in geojson file, parsing one feature at a time from the "features" array.
+# Avoids loading the complete file into memory.
+
+def geojson_features(filename):
+
+	decoder = json.JSONDecoder()
+	file = open(filename)
+	buffer = ""
+	position = 0
+	end_of_file = False
+
+	# Return next non-whitespace character, or "" at end of file
+
+	def next_character():
+		nonlocal buffer, position, end_of_file
+		while True:
+			while position < len(buffer) and buffer[position] in " \t\r\n":
+				position += 1
+			if position < len(buffer) or end_of_file:
+				return buffer[position:position+1]
+			data = file.read(1000000)
+			end_of_file = not data
+			buffer = buffer[position:] + data
+			position = 0
+
+	# Decode next JSON value, reading more of the file until the value is complete
+
+	def next_value():
+		nonlocal buffer, position, end_of_file
+		read_size = 1000000
+		while True:
+			try:
+				value, end = decoder.raw_decode(buffer, position)
+				if end < len(buffer) or end_of_file:  # Numbers may continue in next part of file
+					position = end
+					return value
+			except json.JSONDecodeError:
+				if end_of_file:
+					raise
+			data = file.read(read_size)
+			read_size *= 2  # Avoid decoding large features many times
+			end_of_file = not data
+			buffer = buffer[position:] + data
+			position = 0
+
+	# Skip to "features" array of top level object and decode its features
+
+	try:
+		if next_character() != "{":
+			raise ValueError("GeoJSON object expected in '%s'" % filename)
+		position += 1
+
+		while next_character() not in ["}", ""]:
+			if next_character() == ",":
+				position += 1
+				continue
+
+			key = next_value()
+			if next_character() != ":":
+				raise ValueError("Colon expected after '%s' in '%s'" % (key, filename))
+			position += 1
+			next_character()
+
+			if key != "features":
+				next_value()
+				continue
+
+			if next_character() != "[":
+				raise ValueError("Features array expected in '%s'" % filename)
+			position += 1
+
+			while next_character() not in ["]", ""]:
+				if next_character() == ",":
+					position += 1
 				else:
-					new_line = line2 + line1[1:]
+					yield next_value()
+			return
 
-				ways[ way_ref1 ]['line'] = new_line
-				ways[ way_ref2 ] = { 'delete': True }  # Mark for no later output
-				count += 1
+	finally:
+		file.close()
 
-				# Swap deleted way with combined way in all relevant junctions
-				for node2 in junctions.keys():
-					while way_ref2 in junctions[ node2 ]:
-						junctions[ node2 ].remove(way_ref2)
-						junctions[ node2 ].append(way_ref1)
 
-	# Remove deleted ways from multipolygon members
 
-	for area in areas.values():
-		for member in area['members'][:]:
-			if "delete" in ways[ member['way_ref'] ]:
-				area['members'].remove(member)
-				if debug:
-					area['tags']['KOMBINERT'] = "yes"
+# Check if feature overlaps bbox and has one of the kommune and verneform of selection.
+# The bbox of the outer rings is compared, which is fast compared to building relations.
 
-	message ("Combined %i contiguous ways\n" % count)
+def feature_selected(feature, selection):
 
+	info = feature['properties']
 
+	if selection.get('kommune'):
+		kommuner = [ kommune.strip() for kommune in str(info.get('kommune') or "").split(",") ]
+		if not any(kommune in kommuner for kommune in selection['kommune']):
+			return False
 
-# Simplify line geometry for all ways.
+	if selection.get('verneform') and info.get('verneform') not in selection['verneform']:
+		return False
 
-def simplify_ways():
+	if selection.get('bbox'):
+		min_lon, min_lat, max_lon, max_lat = selection['bbox']
+		outer_nodes = [ point for polygon in feature_polygons(feature) for point in polygon[0] ]
+		if (max(point[0] for point in outer_nodes) < min_lon or min(point[0] for point in outer_nodes) > max_lon
+				or max(point[1] for point in outer_nodes) < min_lat or min(point[1] for point in outer_nodes) > max_lat):
+			return False
 
-	message ("Simplify geometry ...\n")
-	for way in ways:
-		if "delete" not in way and len(way['line']) > 3:
-			new_line = simplify_line(way['line'], simplify_factor)
+	return True
 
-			# Avoid collapsing tiny polygons, including with two tiny segments
-			if (way['line'][0] == way['line'][-1] and len(new_line) > 3
-					or way['line'][0] != way['line'][-1] and len(new_line) > 2):
-				way['line'] = new_line
 
 
+# Generator for features which are selected by feature_selected
 
-# Load data from Naturbase
+def select_features(features, selection):
 
-def load_data(datatype):
+	for feature in features:
+		if feature_selected(feature, selection):
+			yield feature
 
-	if "geojson" in datatype:
-		# Open geojson file (any content)
 
-		file = open(datatype)
-		geojson_data = json.load(file)
-		file.close()
-		features.extend(geojson_data['features'])
 
-	else:
-		# Load data from Miljødirektoratet REST server
+# Group features into connected components of areas which share nodes or area ref.
+# Areas in different components never share ways. Input is list of (ref, feature).
+# Returns list of components, each a list of (ref, feature), in order of first feature.
+
+def feature_components(ref_features):
+
+	parent = list(range(len(ref_features)))  # Union-find of feature positions
+	node_owner = {}  # First feature with each node
+	ref_owner = {}  # First feature with each area ref
 
-		if datatype == "naturvern":
-			endpoint = "https://kart.miljodirektoratet.no/arcgis/rest/services/vern/mapserver/0/"
-		elif datatype == "friluft":
-			endpoint = "https://kart.miljodirektoratet.no/arcgis/rest/services/friluftsliv_statlig_sikra/mapserver/0/"
+	for i, (ref, feature) in enumerate(ref_features):
+		owners = []
+		if ref in ref_owner:
+			owners.append(ref_owner[ ref ])
 		else:
-			sys.exit("Data source '%s' not known\n" % datatype)
+			ref_owner[ ref ] = i
 
-		url = endpoint + "query?where=1=1&outFields=*&geometryPrecision=7&f=geojson&resultRecordCount=1000"
-		filename = datatype.lower()
-		area_data = []
-		page_data = { 'exceededTransferLimit': True }
-		count = 0
+		for polygon in feature_polygons(feature):
+			for ring in polygon:
+				for point in ring:
+					node = node_key(point[0], point[1])
+					if node in node_owner:
+						owners.append(node_owner[ node ])
+					else:
+						node_owner[ node ] = i
 
-		while "exceededTransferLimit" in page_data and count < max_load:
-			request = urllib.request.Request(url + "&resultOffset=%i" % count)  # Paged data
-			file = urllib.request.urlopen(request)
-			page_data = json.load(file)
-			file.close()
-			area_data.extend(page_data['features'])
-			count += len(page_data['features'])
+		for owner in owners:
+			root1 = find_root(parent, owner)
+			root2 = find_root(parent, i)
+			if root1 != root2:
+				parent[ max(root1, root2) ] = min(root1, root2)
 
-		# Output raw data
-		if geojson:
-			file = open(filename + "_raw.geojson", "w")
-			collection = {
-				'type': 'FeatureCollection',
-				'features': area_data
-			}
-			json.dump(collection, file, indent=2, ensure_ascii=False)
-			file.close()
+	components = {}
+	for i, ref_feature in enumerate(ref_features):
+		root = find_root(parent, i)
+		if root not in components:
+			components[ root ] = []
+		components[ root ].append(ref_feature)
 
-		features.extend(area_data)
+	return list(components.values())
 
 
 
-# Indent XML output
+# Find root in union-find list, with path halving
 
-def indent_tree(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent_tree(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+def find_root(parent, i):
 
+	while parent[ i ] != i:
+		parent[ i ] = parent[ parent[ i ] ]
+		i = parent[ i ]
 
+	return i
 
-# Save osm file
 
-def output_file(filename):
 
-	message ("Save to '%s' file...\n" % filename)
+# Build, combine and optionally simplify topology for one component of features, also in worker processes.
+# Settings are keyword arguments for Converter.
+# Returns packed topology, number of combined ways and counters.
 
-	osm_node_ids = {}  # Will contain osm_id of each common node
-	relation_count = 0
-	way_count = 0
-	node_count = 0
+def build_component(component, source, settings, simplify_component):
 
-	osm_root = ET.Element("osm", version="0.6", generator="reserve2osm v"+version, upload="false")
-	osm_id = -1000
+	converter = Converter(source, **settings)
 
-	# Create common nodes at intersections
+	for ref, feature in component:
+		converter.process_feature(feature, ref)
 
-	for way in ways:
-		if "delete" not in way:
-			for node in [ way['line'][0], way['line'][-1] ]:
-				if node not in osm_node_ids:
-					osm_id -= 1
-					osm_node = ET.Element("node", id=str(osm_id), action="modify", lat=str(node[1]), lon=str(node[0]))
-					osm_root.append(osm_node)
-					osm_node_ids[ node ] = osm_id
-					node_count += 1
-
-	# Create ways with remaining nodes
-
-	for way_ref, way in enumerate(ways):
-		if "delete" not in way:
-			osm_id -= 1
-			osm_way = ET.Element("way", id=str(osm_id), action="modify")
-			osm_root.append(osm_way)
-			way['osm_id'] = osm_id
-			way['etree'] = osm_way
-			way_count += 1
-
-			for node in way['line']:
-				if node in osm_node_ids:
-					osm_nd = ET.Element("nd", ref=str(osm_node_ids[ node ]))
-				else:
-					osm_id -= 1
-					osm_node = ET.Element("node", id=str(osm_id), action="modify", lat=str(node[1]), lon=str(node[0]))
-					osm_root.append(osm_node)
-					osm_nd = ET.Element("nd", ref=str(osm_id))
-					node_count += 1
-				osm_way.append(osm_nd)
+	combined_count = converter.combine_ways()
+
+	if simplify_component:
+		converter.simplify_ways()
+
+	return (pack_topology(converter.ways, converter.areas), combined_count, converter.counters)
+
+
+
+# Hash refs and geometry of component, for reusing its topology from the previous run.
+# Coordinates are hashed as node keys, with the number of polygons and nodes to keep rings apart.
+
+def component_key(component):
 
-			if debug:
-				osm_tag = ET.Element("tag", k="WAY_REF", v=str(way_ref))
-				osm_way.append(osm_tag)
+	component_hash = hashlib.sha1()
 
+	for ref, feature in component:
+		multipolygon = feature_polygons(feature)
+		component_hash.update(repr(ref).encode("utf-8") + struct.pack("<Q", len(multipolygon)))
+		for polygon in multipolygon:
+			component_hash.update(struct.pack("<Q", len(polygon)))
+			for ring in polygon:
+				component_hash.update(struct.pack("<Q", len(ring)))
+				component_hash.update(array("q", [ node_key(point[0], point[1]) for point in ring ]).tobytes())
 
-	# Create areas
+	return component_hash.hexdigest()
 
-	for area in areas.values():
 
-		# Output way if possible to avoid relation
-		if len(area['members']) == 1:
-			way = ways[ area['members'][0]['way_ref'] ]
-			osm_area = way['etree']  # Get way for tag output below
-			way['tagged'] = True
 
+# Pack topology of ways and areas into arrays and lists for saving.
+# Lines of all ways are concatenated into one array of node keys.
+
+def pack_topology(ways, areas):
+
+	lines = array("q")
+	line_ends = array("q")
+	way_flags = array("B")  # 1 for no merge, 2 for deleted
+	way_parents = []
+
+	for way in ways:
+		if way.delete:
+			way_flags.append(2)
+			way_parents.append(None)
 		else:
-			# Output relation
-			osm_id -= 1
-			osm_area = ET.Element("relation", id=str(osm_id), action="modify")
-			osm_root.append(osm_area)
-			relation_count += 1
-
-			for member in area['members']:
-				way = ways[ member['way_ref'] ]
-				osm_member = ET.Element("member", type="way", ref=str(way['osm_id']), role=member['role'])
-				osm_area.append(osm_member)
-
-			if datatype == "geojson":
-				osm_tag = ET.Element("tag", k="type", v="multipolygon")
-			else:
-				osm_tag = ET.Element("tag", k="type", v="boundary")
-			osm_area.append(osm_tag)
+			lines.extend(way.line)
+			way_flags.append(int(way.nomerge))
+			way_parents.append(list(way.parents))
+		line_ends.append(len(lines))
+
+	area_data = []
+	for ref, area in iter(areas.items()):
+		members = array("q", [ member.way_ref for member in area.members ])
+		roles = [ member.role for member in area.members ]
+		area_data.append((ref, members, roles, area.tags))
+
+	return {
+		'lines': lines,
+		'line_ends': line_ends,
+		'way_flags': way_flags,
+		'way_parents': way_parents,
+		'areas': area_data
+	}
 
-		# Output tags
-		for key, value in iter(area['tags'].items()):
-			osm_tag = ET.Element("tag", k=key, v=value)
-			osm_area.append(osm_tag)
 
-	# Add boundary tag to untagged ways
 
-	if datatype != "geojson":
-		for way in ways:
-			if "delete" not in way and "tagged" not in way:
-				osm_tag = ET.Element("tag", k="boundary", v="protected_area")
-				way['etree'].append(osm_tag)			
+# Unpack topology from pack_topology.
+# Returns list of ways and dict of areas.
 
-	osm_root.set("upload", "false")
-	indent_tree(osm_root)
-	osm_tree = ET.ElementTree(osm_root)
-	osm_tree.write(filename, encoding='utf-8', method='xml', xml_declaration=True)
+def unpack_topology(data):
 
-	message ("\t%i relations, %i ways, %i nodes saved\n" % (relation_count, way_count, node_count))
+	ways = []
+	areas = {}
+	lines = data['lines']
+	start = 0
 
+	for way_ref, line_end in enumerate(data['line_ends']):
+		flags = data['way_flags'][ way_ref ]
+		if flags & 2:
+			way = Way(None, frozenset())
+			way.delete = True
+			way.nodes = way.parents = None
+		else:
+			way = Way(lines[ start:line_end ])
+			way.parents = set(data['way_parents'][ way_ref ])
+			way.nomerge = bool(flags & 1)
+		ways.append(way)
+		start = line_end
 
+	for ref, members, roles, tags in data['areas']:
+		area = Area()
+		area.members = [ Member(way_ref, role) for way_ref, role in zip(members, roles) ]
+		area.tags = dict(tags)
+		areas[ ref ] = area
 
-# Main program
+	return (ways, areas)
 
-if __name__ == '__main__':
 
-	# Load all protected areas
 
-	start_time = time.time()
-	message ("\nConverting Naturbase protected areas to OSM file\n")
-	message ("Loading data ...")
-
-	features = []  # Will contain geojson features for all protected areas
-
-	datatype = ""
-	if len(sys.argv) > 1:
-		if ".geojson" in sys.argv[1]:
-			datatype = "geojson"
-			filename = sys.argv[1].lower().replace(".geojson", "") + "_relations"
-			load_data(sys.argv[1].lower())  # Load file
-		elif sys.argv[1] == "naturvern":
-			datatype = "naturvern"
-			filename = "naturvernområder"
-			load_data("naturvern")
-		elif sys.argv[1] == "friluft":
-			datatype = "friluft"
-			filename = "friluftsområder"
-			load_data("friluft")
-
-	if not datatype:
-		sys.exit("Please provide 'naturvern', 'friluft' or geojson filename\n")
+# Save data with arrays to zlib compressed checkpoint file.
+# Arrays are replaced by placeholders in a JSON header and saved as little-endian bytes after it,
+# so loading does not execute anything from the file. Tuples are loaded as lists.
 
-	count = len(features)
-	message (" %i %sområder\n" % (count, datatype))
+def save_checkpoint_file(filename, data):
 
-	# Create relations including splitting areas into member ways
+	arrays = []
 
-	message ("Creating relations ...\n")
+	def encode(value):
+		if isinstance(value, array):
+			arrays.append(value)
+			return { '__array__': value.typecode, 'length': len(value) }
+		elif isinstance(value, dict):
+			return { key: encode(item) for key, item in iter(value.items()) }
+		elif isinstance(value, (list, tuple)):
+			return [ encode(item) for item in value ]
+		else:
+			return value
+
+	header = json.dumps(encode(data), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+	compressor = zlib.compressobj(1)
+
+	file = open(filename + ".tmp", "wb")
+	file.write(checkpoint_format)
+	file.write(compressor.compress(struct.pack("<Q", len(header)) + header))
+	for values in arrays:
+		if sys.byteorder == "big":
+			values = array(values.typecode, values)
+			values.byteswap()
+		file.write(compressor.compress(values.tobytes()))
+	file.write(compressor.flush())
+	file.close()
+	os.replace(filename + ".tmp", filename)
 
-	areas = {}  # All protected areas
-	ways = []   # All way segments (members of area multipolygons)
-	ref_id = 0  # Area id for geojson input
 
-	for feature in features:
-		count -= 1
-		message ("\r%i " % count)
-		process_feature(feature)
 
-	message ("\r \t%i protected areas, %i ways\n" % (len(areas), len(ways)))
+# Load data from checkpoint file made by save_checkpoint_file.
+# Returns None if file is not in the current checkpoint format.
 
-	# Simplify ways and output file
+def load_checkpoint_file(filename):
+
+	file = open(filename, "rb")
+	if file.read(len(checkpoint_format)) != checkpoint_format:
+		file.close()
+		return None
+	content = zlib.decompress(file.read())
+	file.close()
+
+	header_length = struct.unpack_from("<Q", content)[0]
+	position = 8 + header_length
+
+	def decode(value):
+		nonlocal position
+		if isinstance(value, dict):
+			if '__array__' in value:
+				values = array(value['__array__'])
+				end = position + value['length'] * values.itemsize
+				values.frombytes(content[ position:end ])
+				if sys.byteorder == "big":
+					values.byteswap()
+				position = end
+				return values
+			return { key: decode(item) for key, item in iter(value.items()) }
+		elif isinstance(value, list):
+			return [ decode(item) for item in value ]
+		else:
+			return value
+
+	return decode(json.loads(content[ 8:position ].decode("utf-8")))
+
+
+
+# Load data from Naturbase into local feature store, or use feature store directly in offline mode.
+# Returns generator of selected features in feature store, or of selected features in geojson file,
+# and the object ids of features selected by the REST server (None for geojson file or offline feature store).
+# Incremental, cache and offline are used for loading from the REST server, as for update_store.
+
+def load_data(datatype, selection=None, incremental=False, cache=True, offline=False):
+
+	if selection is None:
+		selection = {}
+
+	if "geojson" in datatype:
+		# Read features from geojson file (any content) while processing them
+
+		if selection.get('where'):
+			sys.exit("Where clause is only supported for Naturbase, not for geojson file\n")
+
+		if selection:
+			return (select_features(geojson_features(datatype), selection), None)
+		else:
+			return (geojson_features(datatype), None)
+
+	else:
+		# Load data from Miljødirektoratet REST server
+
+		if datatype in endpoints:
+			endpoint = endpoints[ datatype ]
+		else:
+			sys.exit("Data source '%s' not known\n" % datatype)
+
+		filename = datatype.lower()
+
+		for field in ["kommune", "verneform"]:  # Selection fields must be loaded into the feature store
+			if selection.get(field) and field not in out_fields[ datatype ]:
+				sys.exit("Selection by %s is not supported for %s\n" % (field, datatype))
+
+		object_ids = None
+		if offline and os.path.isfile(store_filename % filename) and not selection.get('where'):
+			message (" from feature store ...")
+		else:
+			object_ids = update_store(endpoint, store_filename % filename, datatype, selection, incremental, cache, offline)
+
+		# Output raw data
+		if geojson:
+			file = open(filename + "_raw.geojson", "w")
+			collection = {
+				'type': 'FeatureCollection',
+				'features': list(store_features(store_filename % filename, selection, object_ids))
+			}
+			json.dump(collection, file, indent=2, ensure_ascii=False)
+			file.close()
+
+		return (store_features(store_filename % filename, selection, object_ids), object_ids)
+
+
+
+# Escape XML attribute value, same as ElementTree
+
+def escape_attribute(text):
+
+	for character, entity in [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"),
+								("\r", "&#13;"), ("\n", "&#10;"), ("\t", "&#09;")]:
+		if character in text:
+			text = text.replace(character, entity)
+
+	return text
+
+
+
+# Produce indented XML for element with list of (attribute, value) and list of child elements
+
+def xml_element(name, attributes, children=None):
+
+	element = "<" + name
+	for key, value in attributes:
+		element += ' %s="%s"' % (key, escape_attribute(value))
+
+	if children:
+		element += ">" + "".join("\n    " + child for child in children) + "\n  </%s>" % name
+	else:
+		element += " />"
+
+	return element
+
+
+
+# Produce indented XML for OSM element tuple, with extra attributes after id
+
+def osm_xml_element(element, attributes):
+
+	attributes = [("id", str(element[1]))] + attributes
+
+	if element[0] == "node":
+		node = node_coordinates(element[2])  # Back to degrees
+		return xml_element("node", attributes + [("lat", str(node[1])), ("lon", str(node[0]))])
+
+	if element[0] == "way":
+		osm_children = [ xml_element("nd", [("ref", str(node_id))]) for node_id in element[2] ]
+	else:
+		osm_children = [ xml_element("member", [("type", "way"), ("ref", str(way_id)), ("role", role)]) for way_id, role in element[2] ]
+
+	for key, value in element[3]:
+		osm_children.append(xml_element("tag", [("k", key), ("v", value)]))
+
+	return xml_element(element[0], attributes, osm_children)
+
+
+
+# Write OSM XML file, in the same format and indentation as an ElementTree
+
+def write_osm_xml(file, elements):
+
+	file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+	osm_root = '<osm version="0.6" generator="%s" upload="false"' % escape_attribute("reserve2osm v" + version)
+	element = next(elements, None)
+	if element is None:
+		file.write(osm_root + " />")  # No elements
+		return
+
+	file.write(osm_root + ">")
+
+	while element is not None:
+		file.write("\n  " + osm_xml_element(element, [("action", "modify")]))
+		element = next(elements, None)
+
+	file.write("\n</osm>\n")
+
+
+
+# Get stable negative osm id from hash of content, within 52 bits.
+# Ids already used by other elements are skipped.
+
+def stable_id(content, used_ids):
+
+	osm_id = -1 - int.from_bytes(hashlib.sha1(content).digest()[:7], "little") % 0xFFFFFFFFFFFFF
+	while osm_id in used_ids:
+		osm_id -= 1
+
+	used_ids.add(osm_id)
+	return osm_id
+
+
+
+# Content of OSM element tuple for comparing with previous file
+
+def element_content(element):
+
+	if element[0] == "node":
+		return (element[2],)
+	else:
+		return (tuple(element[2]), tuple(element[3]))
+
+
+
+# Load index of elements in OSM XML file from earlier run.
+# Returns dict with content of nodes, ways and relations for each osm id, as given by element_content.
+
+def load_osm_index(filename):
+
+	if filename.endswith(".pbf"):
+		sys.exit("Previous file must be OSM XML: '%s'\n" % filename)
+	elif filename.endswith(".gz"):
+		file = gzip.open(filename, "rb")
+	elif filename.endswith(".bz2"):
+		file = bz2.open(filename, "rb")
+	else:
+		file = open(filename, "rb")
+
+	index = { 'node': {}, 'way': {}, 'relation': {} }
+
+	for event, element in ET.iterparse(file):
+		if element.tag == "node":
+			index['node'][ int(element.get("id")) ] = (node_key(float(element.get("lon")), float(element.get("lat"))),)
+
+		elif element.tag in ["way", "relation"]:
+			if element.tag == "way":
+				children = tuple(int(child.get("ref")) for child in element.iter("nd"))
+			else:
+				children = tuple((int(child.get("ref")), child.get("role")) for child in element.iter("member"))
+			tags = tuple((tag.get("k"), tag.get("v")) for tag in element.iter("tag"))
+			index[ element.tag ][ int(element.get("id")) ] = (children, tags)
+
+		else:
+			continue
+
+		element.clear()
+
+	file.close()
+
+	return index
+
+
+
+# Write osmChange file with lists of created, modified and deleted elements
+
+def write_osm_change(file, changes):
+
+	file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+	file.write('<osmChange version="0.6" generator="%s">' % escape_attribute("reserve2osm v" + version))
+
+	for action in ["create", "modify", "delete"]:
+		if changes[ action ]:
+			file.write("\n  <%s>" % action)
+			for element in changes[ action ]:
+				file.write("\n    " + osm_xml_element(element, []).replace("\n", "\n  "))
+			file.write("\n  </%s>" % action)
+
+	file.write("\n</osmChange>\n")
+
+
+
+# Encode protobuf varint. Negative values are encoded as 64 bit two's complement (int64).
+
+def pbf_varint(value):
+
+	value &= 0xFFFFFFFFFFFFFFFF
+	data = bytearray()
+	while value > 0x7f:
+		data.append((value & 0x7f) | 0x80)
+		value >>= 7
+	data.append(value)
+
+	return bytes(data)
+
+
+
+# Encode protobuf varint field
+
+def pbf_int(number, value):
+
+	return pbf_varint(number << 3) + pbf_varint(value)
+
+
+
+# Encode protobuf length-delimited field
+
+def pbf_field(number, data):
+
+	return pbf_varint(number << 3 | 2) + pbf_varint(len(data)) + data
+
+
+
+# Encode protobuf packed field of varints, optionally delta coded with zigzag encoding (sint64)
+
+def pbf_packed(number, values, delta=False):
+
+	if delta:
+		previous = 0
+		deltas = []
+		for value in values:
+			deltas.append(((value - previous) << 1) ^ ((value - previous) >> 63))
+			previous = value
+		values = deltas
+
+	return pbf_field(number, b"".join(pbf_varint(value) for value in values))
+
+
+
+# Write zlib compressed blob with header to PBF file
+
+def pbf_blob(file, blob_type, block):
+
+	blob = pbf_int(2, len(block)) + pbf_field(3, zlib.compress(block))
+	header = pbf_field(1, blob_type.encode("utf-8")) + pbf_int(3, len(blob))
+	file.write(struct.pack(">I", len(header)) + header + blob)
+
+
+
+# Write PBF primitive block with one group of dense nodes, ways or relations
+
+def pbf_block(file, elements):
+
+	strings = { "": 0 }  # String table, first string is always empty
+	group = b""
+
+	if elements[0][0] == "node":
+		ids = [ element[1] for element in elements ]
+		lats = [ (element[2] & 0xFFFFFFFF) - 0x80000000 for element in elements ]  # Default granularity is 100 nanodegrees
+		lons = [ element[2] >> 32 for element in elements ]
+		dense = pbf_packed(1, ids, delta=True) + pbf_packed(8, lats, delta=True) + pbf_packed(9, lons, delta=True)
+		group = pbf_field(2, dense)
+
+	else:
+		for element in elements:
+			keys = [ strings.setdefault(key, len(strings)) for key, value in element[3] ]
+			values = [ strings.setdefault(value, len(strings)) for key, value in element[3] ]
+			entity = pbf_int(1, element[1]) + pbf_packed(2, keys) + pbf_packed(3, values)
+
+			if element[0] == "way":
+				entity += pbf_packed(8, element[2], delta=True)
+				group += pbf_field(3, entity)
+			else:
+				roles = [ strings.setdefault(role, len(strings)) for way_id, role in element[2] ]
+				entity += pbf_packed(8, roles) + pbf_packed(9, [ way_id for way_id, role in element[2] ], delta=True)
+				entity += pbf_packed(10, [ 1 ] * len(element[2]))  # Member type way
+				group += pbf_field(4, entity)
+
+	string_table = b"".join(pbf_field(1, string.encode("utf-8")) for string in strings)
+	pbf_blob(file, "OSMData", pbf_field(1, string_table) + pbf_field(2, group))
+
+
+
+# Write OSM PBF file with nodes, ways and relations in blocks of 8000 elements.
+# Elements have no version info, which makes them new elements like the negative ids in the OSM XML file.
+
+def write_osm_pbf(file, elements):
+
+	header = pbf_field(4, b"OsmSchema-V0.6") + pbf_field(4, b"DenseNodes") + pbf_field(16, ("reserve2osm v" + version).encode("utf-8"))
+	pbf_blob(file, "OSMHeader", header)
+
+	nodes = []
+	way_elements = []  # Ways and relations are output after all nodes
+	relation_elements = []
+
+	for element in elements:
+		if element[0] == "node":
+			nodes.append(element)
+			if len(nodes) == 8000:
+				pbf_block(file, nodes)
+				nodes = []
+		elif element[0] == "way":
+			way_elements.append(element)
+		else:
+			relation_elements.append(element)
+
+	for block in [ nodes ] + [ way_elements[i:i+8000] for i in range(0, len(way_elements), 8000) ] + [ relation_elements[i:i+8000] for i in range(0, len(relation_elements), 8000) ]:
+		if block:
+			pbf_block(file, block)
+
+
+
+# Conversion of protected areas from one data source to OSM, with its own state.
+# The stages are load, build, combine, simplify and write.
+
+class Converter:
+
+	def __init__(self, source, jobs=1, profile=False, selection=None, split=True, debug=False, simplify=True, simplify_factor=0.2,
+					incremental=False, checkpoint=False, offline=False, cache=True, stable_ids=False):
+
+		self.source = source  # "naturvern", "friluft" or geojson filename
+		self.selection = dict(selection or {})  # Optional bbox, kommune, verneform and where clause of features
+		self.jobs = 1 if profile else jobs  # Number of processes
+		self.profile = profile
+		self.split = split  # Split polygons into network of relations
+		self.debug = debug  # Add a few extra tags
+		self.simplify_output = simplify  # Simplify lines before output
+		self.simplify_factor = simplify_factor
+		self.incremental = incremental  # Only load changed features, and reuse topology of unchanged components
+		self.checkpoint = checkpoint  # Checkpoints will be saved, so build keeps unsimplified topology
+		self.offline = offline  # Only use feature store or cached pages
+		self.cache = cache  # Keep downloaded pages in cache folder and revalidate them
+		self.stable_ids = stable_ids  # Derive negative osm ids from content in write, as always in write_diff
+
+		if ".geojson" in source:
+			self.datatype = "geojson"
+			self.filename = source.replace(".geojson", "") + "_relations"  # Default output filename
+		else:
+			self.datatype = source
+			self.filename = { 'naturvern': "naturvernområder", 'friluft': "friluftsområder" }.get(source, source)
+
+		self.features = []  # Geojson features for all protected areas, or generator of features
+		self.areas = {}  # All protected areas
+		self.ways = []   # All way segments (members of area multipolygons)
+		self.node_ways = {}  # Way refs using each node
+		self.ref_id = 0  # Area id for geojson input
+		self.combined_count = None  # Number of combined ways, after combining
+		self.simplified = False
+		self.input_hash = None  # Hash of input and settings, for checking checkpoints
+		self.object_ids = None  # Object ids of features selected by the REST server, after load
+
+		self.stages = {}  # Wall time, CPU time and peak memory so far at end of each stage
+		self.stage_start = None
+		self.profilers = {}  # Profiler of each stage
+		self.feature_times = []  # (seconds, ref, nodes, ways scanned) for each feature, when profiling
+		self.way_times = []  # (seconds, way ref, nodes, simplified nodes) for each way, when profiling
+		self.counters = {
+			'features': 0,			# Features decomposed into ways
+			'polygons': 0,			# Outer and inner polygons matched with ways
+			'ways_scanned': 0,		# Nearby ways checked for each polygon
+			'junctions': 0,			# Junctions found for each polygon
+			'way_splits': 0,		# New ways split from existing ways
+			'ways_combined': 0,		# Ways combined into longer ways
+			'nodes_removed': 0		# Nodes removed by simplification
+		}
+
+
+
+	# Start measuring stage, and start profiler for stage if profiling
+
+	def start_stage(self, name):
+
+		self.stage_start = (time.time(), cpu_time())
+
+		if self.profile:
+			if name not in self.profilers:
+				self.profilers[ name ] = cProfile.Profile()
+			self.profilers[ name ].enable()
+
+
+
+	# Add wall time and CPU time since start of stage to metrics, and peak memory of process so far.
+	# Times are added up if the stage is run more than once.
+
+	def end_stage(self, name):
+
+		if self.profile:
+			self.profilers[ name ].disable()
+
+		wall_time = time.time() - self.stage_start[0]
+		process_time = cpu_time() - self.stage_start[1]
+		memory, worker_memory = peak_memory()
+
+		if name not in self.stages:
+			self.stages[ name ] = { 'wall_seconds': 0, 'cpu_seconds': 0 }
+		stage = self.stages[ name ]
+		stage['wall_seconds'] = round(stage['wall_seconds'] + wall_time, 3)
+		stage['cpu_seconds'] = round(stage['cpu_seconds'] + process_time, 3)
+		stage['process_peak_memory_mb'] = memory
+		stage['worker_peak_memory_mb'] = worker_memory
+
+
+
+	# Save profile of each stage to pstats files, and report with slowest features, ways and functions.
+	# Filenames start with given prefix.
+
+	def write_profile(self, prefix):
+
+		message ("Save profile to '%s_profile.txt' file...\n" % prefix)
+
+		file = open(prefix + "_profile.txt", "w", encoding="utf-8")
+		file.write("Profile of reserve2osm v%s for %s\n" % (version, self.source))
+
+		file.write("\nSlowest features\n\n")
+		file.write("%10s  %-20s %10s %13s\n" % ("Seconds", "Ref", "Nodes", "Ways scanned"))
+		for duration, ref, node_count, ways_scanned in heapq.nlargest(profile_count, self.feature_times, key=lambda entry: entry[0]):
+			note = "  (no merge)" if ref in no_merge_areas else ""
+			file.write("%10.4f  %-20s %10i %13i%s\n" % (duration, ref, node_count, ways_scanned, note))
+
+		file.write("\nLongest ways in simplification\n\n")
+		file.write("%10s  %-10s %10s %10s  %s\n" % ("Seconds", "Way ref", "Nodes", "Simplified", "Areas"))
+		for duration, way_ref, node_count, simplified_count in heapq.nlargest(profile_count, self.way_times, key=lambda entry: entry[2]):
+			parents = ", ".join(str(ref) for ref in sorted(self.ways[ way_ref ].parents or [], key=str))
+			file.write("%10.4f  %-10i %10i %10i  %s\n" % (duration, way_ref, node_count, simplified_count, parents))
+
+		for name, profiler in iter(self.profilers.items()):
+			profiler.dump_stats("%s_%s.pstats" % (prefix, name))
+			file.write("\nStage '%s', functions by cumulative time\n\n" % name)
+			pstats.Stats(profiler, stream=file).sort_stats("cumulative").print_stats(profile_count)
+
+		file.close()
+
+
+
+	# Save metrics of stages and counters to json file
+
+	def write_metrics(self, filename):
+
+		metrics = {
+			'version': version,
+			'source': self.source,
+			'jobs': self.jobs,
+			'time': datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+			'stages': self.stages,
+			'counters': self.counters
+		}
+
+		file = open(filename, "w", encoding="utf-8")
+		json.dump(metrics, file, indent=2, ensure_ascii=False)
+		file.write("\n")
+		file.close()
+
+
+
+	# Load features from Naturbase or geojson file.
+	# Also hashes input and settings which give the topology, to detect stale checkpoints.
+	# Features from geojson files and the feature store are only hashed here, and are parsed later in build.
+
+	def load(self):
+
+		self.start_stage("load")
+		message ("Loading data ...")
+
+		self.features, self.object_ids = load_data(self.source, self.selection, self.incremental, self.cache, self.offline)
+
+		input_hash = hashlib.sha1(repr((version, self.datatype, self.split, self.debug, no_merge_areas)).encode("utf-8"))
+
+		if isinstance(self.features, list):
+			for feature in self.features:
+				input_hash.update(json.dumps(feature, sort_keys=True).encode("utf-8"))
+			message (" %i %sområder\n" % (len(self.features), self.datatype))
+
+		elif self.datatype == "geojson":
+			file = open(self.source, "rb")  # Geojson file is hashed without parsing
+			for data in iter(lambda: file.read(1000000), b""):
+				input_hash.update(data)
+			file.close()
+			if self.selection:
+				input_hash.update(repr(sorted(self.selection.items())).encode("utf-8"))
+			message ("\n")
+
+		else:
+			count = store_hash(store_filename % self.source.lower(), self.selection, input_hash, self.object_ids)  # Feature blobs are hashed without decoding
+			message (" %i %sområder\n" % (count, self.datatype))
+
+		self.input_hash = input_hash.hexdigest()
+		self.end_stage("load")
+
+
+
+	# Add way as member of area and register area as parent of way
+
+	def add_member(self, ref, way_ref, role):
+
+		self.areas[ ref ].members.append(Member(way_ref, role))
+		self.ways[ way_ref ].parents.add(ref)
+
+
+
+	# Add way to node index
+
+	def index_way(self, way_ref):
+
+		for node in self.ways[ way_ref ].line:
+			if node not in self.node_ways:
+				self.node_ways[ node ] = set()
+			self.node_ways[ node ].add(way_ref)
+
+
+
+	# Remove way from node index
+
+	def unindex_way(self, way_ref):
+
+		for node in self.ways[ way_ref ].line:
+			if node in self.node_ways:
+				self.node_ways[ node ].discard(way_ref)
+				if not self.node_ways[ node ]:
+					del self.node_ways[ node ]
+
+
+
+	# Decompose outer/inner polygon into way segments
+
+	def process_polygon(self, ref, input_polygon, role):
+
+		polygon = array("q", [ node_key(point[0], point[1]) for point in input_polygon ])
+
+		# Skip matching if blacklisted
+
+		if not self.split or ref in no_merge_areas:
+			self.ways.append(Way(polygon))
+			self.add_member(ref, len(self.ways) - 1, role)
+			self.ways[-1].nomerge = True
+			return
+
+		# Build list of ways intersecting with polygon from node index, even for one node (touching rings)
+
+		polygon_set = frozenset(polygon)
+		near_ways = set()
+
+		for node in polygon_set:
+			if node in self.node_ways:
+				near_ways.update(self.node_ways[ node ])
+
+		near_ways = sorted(near_ways)
+		self.counters['polygons'] += 1
+		self.counters['ways_scanned'] += len(near_ways)
+
+		# Create new way if no matching ways
+
+	#	if not near_ways:
+	#		self.ways.append(Way(polygon))
+	#		self.add_member(ref, len(self.ways) - 1, role)
+	#		return		
+
+		# Loop intersecting ways and split/match
+
+		junctions = set()
+		match_ways = {}  # Split ways which may match polygon segments, keyed by set of nodes
+
+		for way_ref in near_ways:
+			way = self.ways[ way_ref ]
+			way_line = way.line
+			way_set = way.nodes
+
+			# Quick exit for exact match
+
+			if way_set == polygon_set:
+				self.add_member(ref, way_ref, role)
+				return
+
+			# Discover junctions
+
+			for i in range(1, len(polygon) - 1):
+				if polygon[i] in way_set and (polygon[i-1] not in way_set or polygon[i+1] not in way_set):
+					junctions.add(polygon[i])
+
+			for i in range(1, len(way_line) - 1):
+				if way_line[i] in polygon_set and (way_line[i-1] not in polygon_set or way_line[i+1] not in polygon_set):
+					junctions.add(way_line[i])			
+
+			if not junctions:
+				continue  # No match
+
+			for i in [0,-1]:
+				junctions.add(polygon[i])
+				junctions.add(way_line[i])
+
+			# Split way at each junction
+
+			way_refs = []
+
+			for new_line, new_set in split_line(way_line, junctions):
+				if not way_refs:
+					self.unindex_way(way_ref)
+					way.line = new_line
+					way.nodes = new_set
+					self.index_way(way_ref)
+					way_refs.append(way_ref)
+				else:
+					self.ways.append(Way(new_line, new_set))
+					self.index_way(len(self.ways) - 1)
+					way_refs.append(len(self.ways) - 1)
+
+				if len(polygon_set & new_set) > 1:
+					if new_set not in match_ways:
+						match_ways[ new_set ] = []
+					match_ways[ new_set ].append(way_refs[-1])
+
+			# Update members which already refer to way
+
+			if len(way_refs) > 1:
+				self.counters['way_splits'] += len(way_refs) - 1
+				for area_ref in way.parents:
+					members = self.areas[ area_ref ].members
+					for i, member in enumerate(members):
+						if member.way_ref == way_ref:
+							new_members = []
+							for member_ref in way_refs:
+								new_members.append(Member(member_ref, member.role))
+							members[i:i+1] = new_members
+							break
+
+				for member_ref in way_refs[1:]:
+					self.ways[ member_ref ].parents = set(way.parents)
+
+		# Add self-intersecting junctions for polygon
+
+		polygon_set = set([polygon[0], polygon[-1]])
+		for node in polygon[1:-1]:
+			if node in polygon_set:
+				junctions.add(node)
+			polygon_set.add(node)
+
+		# Split polygon at junctions
+
+		self.counters['junctions'] += len(junctions)
+		segments = []
+
+		for new_line, new_set in split_line(polygon, junctions):
+			if not(len(new_line) == 2 and new_line[0] == new_line[-1]):
+				segments.append((new_line, new_set))
+
+		# Match polygon segments with ways, or create new ways if no match
+
+		for segment, segment_set in segments:
+			if match_ways.get(segment_set):
+				self.add_member(ref, match_ways[ segment_set ].pop(0), role)
+			else:
+				self.ways.append(Way(segment, segment_set))
+				self.index_way(len(self.ways) - 1)
+				self.add_member(ref, len(self.ways) - 1, role)
+
+
+
+	# Get area ref of feature, or None for small circles representing a point
+
+	def feature_ref(self, feature):
+
+		coordinates = feature_polygons(feature)[0][0]
+		if (len(coordinates) == 41
+				and coordinates[10][1] - coordinates[30][1] < 0.000180
+				and coordinates[10][1] - coordinates[30][1] > 0.000176):
+			return None
+
+		if self.datatype == "geojson":
+			self.ref_id += 1
+			return self.ref_id
+		else:
+			return feature['properties'][ self.datatype + 'Id' ]
+
+
+
+	# Produce tags of area from properties of feature
+
+	def area_tags(self, ref, info):
+
+		if self.datatype == "geojson":
+			tags = {}
+			for key, value in iter(info.items()):
+				if value:
+					tags[ key ] = str(value)
+		else:
+			tags = get_tags(info, self.datatype, self.debug)
+			if ref in no_merge_areas:
+				tags['NOTE'] = "Polygonet er ikke flettet med andre verneområder"
+
+		return tags
+
+
+
+	# Create data structure for feature and decompose line segments
+
+	def process_feature(self, feature, ref=None):
+
+		info = feature['properties']
+		multipolygon = feature_polygons(feature)
+
+		if ref is None:
+			ref = self.feature_ref(feature)
+			if ref is None:
+				return
+
+		self.counters['features'] += 1
+
+		# Init data structure.
+		# Areas may appear multiple times as geojson features, one for each outer area
+
+		if ref not in self.areas:
+			self.areas[ ref ] = Area()
+			self.areas[ ref ].tags = self.area_tags(ref, info)
+
+		# Create way segments for polygon/multipolygon.
+		# A multipolygon is a list of polygons, each with one outer and multiple inner patches
+
+		for polygon in multipolygon:
+			self.process_polygon (ref, polygon[0], "outer")
+			for inner in polygon[1:]:
+				self.process_polygon (ref, inner, "inner")
+
+
+
+	# Build topology of components, largest components first, in process pool if more than one job.
+	# With incremental, the topology of components which have not changed since the previous run
+	# is reused from the component store, with fresh area tags.
+	# Ways and areas of components are merged in component order, with way refs renumbered.
+	# Returns number of combined ways.
+
+	def build_components(self, components):
+
+		results = [ None ] * len(components)  # Packed topology and number of combined ways of each component
+		keys = []
+		store_filename = self.filename + "_components.checkpoint"
+		store_settings = [ version, self.datatype, self.split, self.debug, no_merge_areas ]
+		settings = { 'split': self.split, 'debug': self.debug, 'simplify_factor': self.simplify_factor }
+
+		if self.incremental:
+			keys = [ component_key(component) for component in components ]
+			if os.path.isfile(store_filename):
+				store = load_checkpoint_file(store_filename)
+				if store is not None and store['settings'] == store_settings:
+					for i, key in enumerate(keys):
+						results[ i ] = store['components'].get(key)
+				del store
+
+		rebuild = [ i for i in range(len(components)) if results[ i ] is None ]
+		message ("\t%i connected components, %i to build\n" % (len(components), len(rebuild)))
+
+		pool = None
+		futures = {}
+		if self.jobs > 1 and len(rebuild) > 1:
+			pool = ProcessPoolExecutor(max_workers=self.jobs)
+			for i in sorted(rebuild, key=lambda i: len(components[ i ]), reverse=True):
+				futures[ i ] = pool.submit(build_component, components[ i ], self.source, settings, self.simplified)
+
+		combined_count = 0
+		done_count = 0
+
+		for i, component in enumerate(components):
+			reused = results[ i ] is not None
+			if not reused:
+				if pool is not None:
+					topology, component_count, counters = futures.pop(i).result()
+				else:
+					topology, component_count, counters = build_component(component, self.source, settings, self.simplified)
+				results[ i ] = (topology, component_count)
+				for key, value in iter(counters.items()):
+					self.counters[ key ] += value
+				done_count += 1
+				progress (done_count)
+
+			topology, component_count = results[ i ]
+			component_ways, component_areas = unpack_topology(topology)
+
+			if reused:  # Tags may have changed without changing geometry
+				tagged_refs = set()
+				for ref, feature in component:
+					if ref not in tagged_refs:
+						tagged_refs.add(ref)
+						tags = self.area_tags(ref, feature['properties'])
+						if self.debug and 'KOMBINERT' in component_areas[ ref ].tags:
+							tags['KOMBINERT'] = "yes"
+						component_areas[ ref ].tags = tags
+
+			offset = len(self.ways)
+			self.ways.extend(component_ways)
+
+			for way_ref in range(offset, len(self.ways)):
+				if not self.ways[ way_ref ].delete and not self.ways[ way_ref ].nomerge:
+					self.index_way(way_ref)
+
+			for ref, area in iter(component_areas.items()):
+				for member in area.members:
+					member.way_ref += offset
+				self.areas[ ref ] = area
+
+			combined_count += component_count
+
+		if pool is not None:
+			pool.shutdown()
+
+		if self.incremental:
+			save_checkpoint_file(store_filename, { 'settings': store_settings, 'components': dict(zip(keys, results)) })
+
+		return combined_count
+
+
+
+	# Process feature and record its time, number of nodes and nearby ways scanned, for profile report
+
+	def profile_feature(self, feature):
+
+		ref = self.feature_ref(feature)
+		if ref is None:
+			return
+
+		ways_scanned = self.counters['ways_scanned']
+		start_time = time.perf_counter()
+
+		self.process_feature(feature, ref)
+
+		duration = time.perf_counter() - start_time
+		node_count = sum(len(ring) for polygon in feature_polygons(feature) for ring in polygon)
+		self.feature_times.append((duration, ref, node_count, self.counters['ways_scanned'] - ways_scanned))
+
+
+
+	# Create relations including splitting areas into member ways.
+	# With more than one job or incremental, connected components of areas are also combined, and components are
+	# built in a process pool or reused from the previous run.
+	# Features are released after processing.
+
+	def build(self):
+
+		self.start_stage("build")
+		message ("Creating relations ...\n")
+
+		features = self.features
+		self.features = []
+
+		if isinstance(features, list):
+			feature_list = features
+			feature_list.reverse()  # Pop features in original order to release them after processing
+			features = (feature_list.pop() for i in range(len(feature_list)))
+
+		if self.split and (self.jobs > 1 or self.incremental) and not self.profile:
+			ref_features = []
+			for feature in features:
+				ref = self.feature_ref(feature)
+				if ref is not None:
+					ref_features.append((ref, feature))
+
+			components = feature_components(ref_features)
+			del ref_features
+			self.simplified = self.simplify_output and not self.checkpoint and not self.incremental  # Keep unsimplified topology for checkpoints
+			self.combined_count = self.build_components(components)
+
+		else:
+			count = 0
+			for feature in features:
+				count += 1
+				progress (count)
+				if self.profile:
+					self.profile_feature(feature)
+				else:
+					self.process_feature(feature)
+
+		clear_progress()
+		message ("\r \t%i protected areas, %i ways\n" % (len(self.areas), len(self.ways)))
+		self.end_stage("build")
+
+
+
+	# Combine non-branching ways into longer ways
+
+	def combine_ways(self):
+
+		# Build dict of junctions with set of all connected ways
+
+		junctions = {}
+		for way_ref, way in enumerate(self.ways):
+			if not way.nomerge:
+				for node in [ way.line[0], way.line[-1] ]:
+					if node not in junctions:
+						junctions[ node ] = []  # Set not used due to self-intersecting rings
+					junctions[ node ].append(way_ref)
+
+		# Iterate junctions and combine if no branching (2 ways with identical parents).
+		# Combined ways are looked up through aliases instead of being swapped in all junctions.
+		# Lines are kept as lists of [way ref, line, start index] pieces and joined after all merges.
+
+		alias = {}  # Deleted way ref -> (combined way ref, merge count)
+		pieces = {}  # Combined way ref -> pieces of combined line
+		count = 0
+		combined_areas = set()  # Areas with deleted member ways
+
+		for node, junction in iter(junctions.items()):
+
+			if len(junction) == 2:
+				# Ways swapped at latest merge come last, like moving them to end of junction
+				way1 = resolve_way(alias, junction[0])
+				way2 = resolve_way(alias, junction[1])
+				if way2[1] < way1[1]:
+					way1, way2 = way2, way1
+				way_ref1 = way1[0]
+				way_ref2 = way2[0]
+
+				if way_ref1 != way_ref2 and self.ways[ way_ref1 ].parents == self.ways[ way_ref2 ].parents:
+					for way_ref in [way_ref1, way_ref2]:
+						if way_ref not in pieces:
+							pieces[ way_ref ] = [ [ way_ref, self.ways[ way_ref ].line, 0 ] ]
+
+					pieces1 = pieces[ way_ref1 ]
+					pieces2 = pieces.pop(way_ref2)
+
+					# Connect at node position, even for ring. Ways have same direction.
+					if pieces1[-1][1][-1] == node:
+						pieces2[0][2] += 1
+						pieces1.extend(pieces2)
+					else:
+						pieces1[0][2] += 1
+						pieces2.extend(pieces1)
+						pieces[ way_ref1 ] = pieces2
+
+					combined_areas.update(self.ways[ way_ref2 ].parents)
+					self.ways[ way_ref2 ].delete = True  # Mark for no later output
+					self.ways[ way_ref2 ].line = self.ways[ way_ref2 ].nodes = self.ways[ way_ref2 ].parents = None
+					count += 1
+					alias[ way_ref2 ] = (way_ref1, count)
+
+		# Join pieces of combined ways and move node index to combined way
+
+		for way_ref, way_pieces in iter(pieces.items()):
+			new_line = array("q")
+			for piece_ref, line, start in way_pieces:
+				new_line.extend(line[start:])
+				if piece_ref != way_ref:
+					for node in line:
+						self.node_ways[ node ].discard(piece_ref)
+						self.node_ways[ node ].add(way_ref)
+
+			self.ways[ way_ref ].line = new_line
+			self.ways[ way_ref ].nodes = frozenset(new_line)
+
+		# Remove deleted ways from multipolygon members
+
+		for area_ref in combined_areas:
+			area = self.areas[ area_ref ]
+			area.members = [ member for member in area.members if not self.ways[ member.way_ref ].delete ]
+			if self.debug:
+				area.tags['KOMBINERT'] = "yes"
+
+		self.counters['ways_combined'] += count
+		return count
+
+
+
+	# Combine non-branching ways into longer ways, unless already done in build.
+	# Returns number of combined ways.
+
+	def combine(self):
+
+		self.start_stage("combine")
+		if self.combined_count is None:
+			self.combined_count = self.combine_ways()
+		self.end_stage("combine")
+
+		message ("Combined %i contiguous ways\n" % self.combined_count)
+		return self.combined_count
+
+
+
+	# Simplify line geometry for all ways.
+	# With more than one job, batches of ways are simplified in a process pool.
+
+	def simplify_ways(self):
+
+		way_refs = [ way_ref for way_ref, way in enumerate(self.ways) if not way.delete and len(way.line) > 3 ]
+		new_lines = {}
+
+		if self.jobs > 1 and len(way_refs) > 1:
+
+			# Distribute ways to batches, longest ways first to the batch with fewest nodes so far
+
+			batch_count = min(len(way_refs), 4 * self.jobs)
+			batches = [ [] for i in range(batch_count) ]
+			batch_sizes = [ (0, i) for i in range(batch_count) ]
+
+			for way_ref in sorted(way_refs, key=lambda way_ref: len(self.ways[ way_ref ].line), reverse=True):
+				size, i = heapq.heappop(batch_sizes)
+				batches[ i ].append(way_ref)
+				heapq.heappush(batch_sizes, (size + len(self.ways[ way_ref ].line), i))
+
+			batch_lines = [ [ self.ways[ way_ref ].line for way_ref in batch ] for batch in batches ]
+
+			with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+				results = pool.map(simplify_lines, batch_lines, [ self.simplify_factor ] * batch_count)
+				for batch, lines in zip(batches, results):
+					new_lines.update(zip(batch, lines))
+
+		elif self.profile:
+			# Simplify one way at a time and record time for profile report
+			for way_ref in way_refs:
+				start_time = time.perf_counter()
+				new_lines[ way_ref ] = simplify_lines([ self.ways[ way_ref ].line ], self.simplify_factor)[0]
+				duration = time.perf_counter() - start_time
+				self.way_times.append((duration, way_ref, len(self.ways[ way_ref ].line), len(new_lines[ way_ref ])))
+
+		else:
+			new_lines.update(zip(way_refs, simplify_lines([ self.ways[ way_ref ].line for way_ref in way_refs ], self.simplify_factor)))
+
+		for way_ref in way_refs:
+			way = self.ways[ way_ref ]
+			new_line = new_lines[ way_ref ]
+
+			# Avoid collapsing tiny polygons, including with two tiny segments
+			if (way.line[0] == way.line[-1] and len(new_line) > 3
+					or way.line[0] != way.line[-1] and len(new_line) > 2):
+				self.counters['nodes_removed'] += len(way.line) - len(new_line)
+				way.line = new_line
+				way.nodes = frozenset(new_line)
+
+
+
+	# Simplify line geometry for all ways, unless already done in build or simplification is off
+
+	def simplify(self):
+
+		if self.simplify_output and not self.simplified:
+			self.start_stage("simplify")
+			message ("Simplify geometry ...\n")
+			self.simplify_ways()
+			self.simplified = True
+			self.end_stage("simplify")
+
+
+
+	# Save topology of ways and areas to binary checkpoint file
+
+	def save_checkpoint(self, filename):
+
+		self.start_stage("checkpoint")
+		message ("Save checkpoint to '%s' ...\n" % filename)
+
+		data = {
+			'version': version,
+			'input_hash': self.input_hash,
+			'combined_count': self.combined_count,
+			'simplified': self.simplified,
+			'ref_id': self.ref_id,
+			'topology': pack_topology(self.ways, self.areas)
+		}
+
+		save_checkpoint_file(filename, data)
+		self.end_stage("checkpoint")
+
+
+
+	# Load topology of ways and areas from checkpoint file, and rebuild node index.
+	# Returns False if checkpoint was made for another input (after load), version or file format.
+
+	def load_checkpoint(self, filename):
+
+		self.start_stage("resume")
+		message ("Load checkpoint from '%s' ...\n" % filename)
+
+		data = load_checkpoint_file(filename)
+
+		if data is None or data['version'] != version or self.input_hash is not None and data['input_hash'] != self.input_hash:
+			self.end_stage("resume")
+			return False
+
+		self.ways, self.areas = unpack_topology(data['topology'])
+		self.node_ways = {}
+
+		for way_ref, way in enumerate(self.ways):
+			if not way.delete and not way.nomerge:
+				self.index_way(way_ref)
+
+		self.combined_count = data['combined_count']
+		self.simplified = data['simplified']
+		self.ref_id = data['ref_id']
+		self.features = []
+
+		message ("\t%i protected areas, %i ways\n" % (len(self.areas), len(self.ways)))
+		self.end_stage("resume")
+		return True
+
+
+
+	# Produce OSM elements in output order, with negative osm ids.
+	# Yields ("node", id, node key), ("way", id, node ids, tags) and ("relation", id, members, tags) tuples.
+	# Counts of elements are updated in the given dict.
+	# Stable ids are derived from node keys, the set of nodes of ways and area refs of relations.
+
+	def osm_elements(self, counts, stable=False):
+
+		osm_node_ids = {}  # Will contain osm_id of each common node
+		osm_way_ids = {}  # Will contain osm_id of each way
+		osm_id = -1000
+		used_ids = { 'node': set(), 'way': set(), 'relation': set() }  # Stable ids already given
+
+		# Get next osm id for node key, way ref or area ref
+
+		def next_id(element_type, key):
+			nonlocal osm_id
+			if not stable:
+				osm_id -= 1
+				return osm_id
+			elif element_type == "node":
+				content = struct.pack("<q", key)
+			elif element_type == "way":
+				content = array("q", sorted(self.ways[ key ].nodes)).tobytes()
+			else:
+				content = repr(key).encode("utf-8")
+			return stable_id(content, used_ids[ element_type ])
+
+		# Create common nodes at intersections
+
+		for way in self.ways:
+			if not way.delete:
+				for node in [ way.line[0], way.line[-1] ]:
+					if node not in osm_node_ids:
+						osm_node_ids[ node ] = next_id("node", node)
+						counts['node'] += 1
+						yield ("node", osm_node_ids[ node ], node)
+
+		# Tags of areas which will be output as ways to avoid relation
+
+		way_tags = {}
+		for area in self.areas.values():
+			if len(area.members) == 1:
+				way_ref = area.members[0].way_ref
+				if way_ref not in way_tags:
+					way_tags[ way_ref ] = []
+				way_tags[ way_ref ].extend(area.tags.items())
+
+		# Create ways with remaining nodes, which are output after their way
+
+		for way_ref, way in enumerate(self.ways):
+			if not way.delete:
+				way_id = next_id("way", way_ref)
+				osm_way_ids[ way_ref ] = way_id
+				node_ids = []
+				new_nodes = []
+				tags = []
+				counts['way'] += 1
+
+				for node in way.line:
+					if node in osm_node_ids:
+						node_ids.append(osm_node_ids[ node ])
+					else:
+						node_id = next_id("node", node)
+						node_ids.append(node_id)
+						new_nodes.append(("node", node_id, node))
+						counts['node'] += 1
+
+				if self.debug:
+					tags.append(("WAY_REF", str(way_ref)))
+
+				# Area tags, or boundary tag for untagged ways
+				if way_ref in way_tags:
+					tags.extend(way_tags[ way_ref ])
+				elif self.datatype != "geojson":
+					tags.append(("boundary", "protected_area"))
+
+				yield ("way", way_id, node_ids, tags)
+				yield from new_nodes
+
+		# Create relations for areas with more than one way
+
+		for ref, area in iter(self.areas.items()):
+			if len(area.members) != 1:
+				relation_id = next_id("relation", ref)
+				members = [ (osm_way_ids[ member.way_ref ], member.role) for member in area.members ]
+				counts['relation'] += 1
+
+				if self.datatype == "geojson":
+					tags = [("type", "multipolygon")]
+				else:
+					tags = [("type", "boundary")]
+				tags.extend(area.tags.items())
+
+				yield ("relation", relation_id, members, tags)
+
+
+
+	# Save osm file. Default filename is given by data source.
+	# Format is given by file extension: .osm, .osm.gz, .osm.bz2 or .osm.pbf.
+
+	def write(self, filename=None):
+
+		if filename is None:
+			filename = self.filename + ".osm"
+
+		self.start_stage("write")
+		message ("Save to '%s' file...\n" % filename)
+
+		counts = { 'node': 0, 'way': 0, 'relation': 0 }
+		elements = self.osm_elements(counts, self.stable_ids)
+
+		if filename.endswith(".pbf"):
+			file = open(filename, "wb")
+			write_osm_pbf(file, elements)
+		else:
+			if filename.endswith(".gz"):
+				file = gzip.open(filename, "wt", encoding="utf-8", errors="xmlcharrefreplace")
+			elif filename.endswith(".bz2"):
+				file = bz2.open(filename, "wt", encoding="utf-8", errors="xmlcharrefreplace")
+			else:
+				file = open(filename, "w", encoding="utf-8", errors="xmlcharrefreplace")
+			write_osm_xml(file, elements)
+
+		file.close()
+
+		message ("\t%i relations, %i ways, %i nodes saved\n" % (counts['relation'], counts['way'], counts['node']))
+		self.end_stage("write")
+
+
+
+	# Save osmChange file with changes since previous file, given as index from load_osm_index.
+	# Elements have stable ids, so unchanged elements keep the ids of the previous file.
+
+	def write_diff(self, filename, previous):
+
+		self.start_stage("diff")
+		message ("Save changes to '%s' file...\n" % filename)
+
+		counts = { 'node': 0, 'way': 0, 'relation': 0 }
+		changes = { 'create': [], 'modify': [], 'delete': [] }
+		current_ids = { 'node': set(), 'way': set(), 'relation': set() }
+
+		for element in self.osm_elements(counts, True):
+			current_ids[ element[0] ].add(element[1])
+			previous_content = previous[ element[0] ].get(element[1])
+			if previous_content is None:
+				changes['create'].append(element)
+			elif previous_content != element_content(element):
+				changes['modify'].append(element)
+
+		for element_type in ["relation", "way", "node"]:
+			for osm_id, content in iter(previous[ element_type ].items()):
+				if osm_id not in current_ids[ element_type ]:
+					changes['delete'].append((element_type, osm_id) + content)
+
+		# Nodes before ways before relations when creating or modifying, and opposite when deleting
+
+		type_order = { 'node': 0, 'way': 1, 'relation': 2 }
+		for action in ["create", "modify"]:
+			changes[ action ].sort(key=lambda element: type_order[ element[0] ])
+
+		file = open(filename, "w", encoding="utf-8", errors="xmlcharrefreplace")
+		write_osm_change(file, changes)
+		file.close()
+
+		message ("\t%i created, %i modified, %i deleted\n" % (len(changes['create']), len(changes['modify']), len(changes['delete'])))
+		self.end_stage("diff")
+
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	# Options
+
+	if "--jobs" in sys.argv[:-1]:
+		jobs = int(sys.argv[ sys.argv.index("--jobs") + 1 ])
+
+	if "--offline" in sys.argv:
+		offline = True
+
+	if "--incremental" in sys.argv:
+		incremental = True
+
+	if "--checkpoint" in sys.argv:
+		checkpoint = True
+
+	output_filename = ""
+	if "--output" in sys.argv[:-1]:
+		output_filename = sys.argv[ sys.argv.index("--output") + 1 ]
+
+	resume_filename = ""
+	if "--resume-from" in sys.argv[:-1]:
+		resume_filename = sys.argv[ sys.argv.index("--resume-from") + 1 ]
+
+	if "--stable-ids" in sys.argv:
+		stable_ids = True
+
+	if "--profile" in sys.argv:
+		profile = True
+
+	metrics_filename = ""
+	if "--metrics" in sys.argv[:-1]:
+		metrics_filename = sys.argv[ sys.argv.index("--metrics") + 1 ]
+
+	selection = {}
+	if "--bbox" in sys.argv[:-1]:
+		selection['bbox'] = [ float(value) for value in sys.argv[ sys.argv.index("--bbox") + 1 ].split(",") ]
+		if len(selection['bbox']) != 4:
+			sys.exit("Please provide bbox as min_lon,min_lat,max_lon,max_lat\n")
+
+	if "--kommune" in sys.argv[:-1]:
+		selection['kommune'] = [ kommune.strip() for kommune in sys.argv[ sys.argv.index("--kommune") + 1 ].split(",") ]
+
+	if "--verneform" in sys.argv[:-1]:
+		selection['verneform'] = [ verneform.strip() for verneform in sys.argv[ sys.argv.index("--verneform") + 1 ].split(",") ]
+
+	if "--where" in sys.argv[:-1]:
+		selection['where'] = sys.argv[ sys.argv.index("--where") + 1 ]
+
+	previous_filename = ""
+	if "--diff" in sys.argv[:-1]:
+		previous_filename = sys.argv[ sys.argv.index("--diff") + 1 ]
+		stable_ids = True
+
+	if len(sys.argv) < 2 or ".geojson" not in sys.argv[1] and sys.argv[1] not in endpoints:
+		sys.exit("Please provide 'naturvern', 'friluft' or geojson filename\n")
+
+	source = sys.argv[1]
+	if ".geojson" in source:
+		source = source.lower()
+
+	# Convert all protected areas
+
+	start_time = time.time()
+	message ("\nConverting Naturbase protected areas to OSM file\n")
+
+	converter = Converter(source, jobs, profile, selection, split=split, debug=debug, simplify=simplify, simplify_factor=simplify_factor,
+							incremental=incremental, checkpoint=checkpoint, offline=offline, cache=cache, stable_ids=stable_ids)
+	converter.load()
+
+	resumed = False
+	if resume_filename:
+		resumed = converter.load_checkpoint(resume_filename)
+		if not resumed:
+			message ("\t*** Checkpoint is not made from current input, rebuilding\n")
+
+	if not resumed:
+		converter.build()
+		if converter.checkpoint:
+			stage = "combine" if converter.combined_count is not None else "build"  # Ways are combined in build with --jobs
+			converter.save_checkpoint(converter.filename + "_%s.checkpoint" % stage)
+
+	if converter.split:
+		combined = converter.combined_count is not None  # Combined in build or checkpoint
+		converter.combine()
+		if converter.checkpoint and not combined:
+			converter.save_checkpoint(converter.filename + "_combine.checkpoint")
+
+	converter.simplify()
+
+	if previous_filename:  # Load before output, which may replace it
+		message ("Load previous file '%s' ...\n" % previous_filename)
+		previous = load_osm_index(previous_filename)
+
+	if output_filename:
+		converter.write(output_filename)
+	else:
+		converter.write()
 
-	if split:
-		combine_ways()
+	if previous_filename:
+		diff_filename = output_filename or converter.filename + ".osm"
+		for extension in [".gz", ".bz2", ".pbf", ".osm"]:
+			if diff_filename.endswith(extension):
+				diff_filename = diff_filename[:-len(extension)]
+		converter.write_diff(diff_filename + ".osc", previous)
 
-	if simplify:
-		simplify_ways()
+	if metrics_filename:
+		converter.write_metrics(metrics_filename)
 
-	output_file(filename + ".osm")
+	if profile:
+		converter.write_profile(converter.filename)
 
 	duration = time.time() - start_time
 	message ("Time: %i seconds\n\n" % duration)
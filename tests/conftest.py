@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+
+# Local stand-in for ArcGIS REST layer with canned features.
+# Supports count, id and paged geojson queries, conditional requests with ETag/Last-Modified,
+# and injected failures: "500" for an error status, "drop" for a dropped connection.
+
+class ArcGISServer:
+
+	def __init__(self, features):
+
+		self.features = features
+		self.max_records = 1000  # Max features returned per request, like the server limit
+		self.failures = []  # Failure for each of the next requests, or None
+		self.delay = None  # Function of query giving seconds to wait before responding
+		self.etag = True  # Send ETag and Last-Modified headers
+		self.not_modified = False  # Answer all conditional requests with 304
+		self.requests = []  # (path with query, headers) of each request
+		self.lock = threading.Lock()
+
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, *args):
+				pass
+
+			def do_GET(self):
+				server.handle(self)
+
+		self.http_server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.url = "http://127.0.0.1:%i/arcgis/rest/services/vern/mapserver/0/" % self.http_server.server_address[1]
+		threading.Thread(target=self.http_server.serve_forever, args=(0.05,), daemon=True).start()
+
+
+	def queries(self, key):
+
+		return [ query for path, headers in self.requests for query in [ urllib.parse.parse_qs(urllib.parse.urlsplit(path).query) ] if key in query ]
+
+
+	def handle(self, handler):
+
+		query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)
+		with self.lock:
+			self.requests.append((handler.path, dict(handler.headers)))
+			failure = self.failures.pop(0) if self.failures else None
+
+		if failure == "drop":
+			handler.connection.shutdown(socket.SHUT_RDWR)
+			handler.close_connection = True
+			return
+
+		if failure == "500":
+			self.respond(handler, 500, b"Internal error")
+			return
+
+		if self.delay:
+			time.sleep(self.delay(query))
+
+		if "where" not in query:  # Layer info
+			data = { 'editFieldsInfo': { 'editDateField': "EditDate" } }
+		elif "returnCountOnly" in query:
+			data = { 'count': len(self.features) }
+		elif "returnIdsOnly" in query:
+			data = { 'objectIdFieldName': "OBJECTID", 'objectIds': [ feature['properties']['OBJECTID'] for feature in self.features ] }
+		else:
+			offset = int(query['resultOffset'][0])
+			count = min(int(query['resultRecordCount'][0]), self.max_records)
+			data = { 'type': "FeatureCollection", 'features': self.features[ offset : offset + count ] }
+			if offset + count < len(self.features):
+				data['exceededTransferLimit'] = True
+
+		body = json.dumps(data).encode("utf-8")
+		headers = {}
+		if self.etag:
+			headers['ETag'] = '"%s"' % hashlib.md5(body).hexdigest()
+			headers['Last-Modified'] = "Mon, 01 Jan 2024 00:00:00 GMT"
+			if handler.headers.get("If-None-Match") == headers['ETag'] or self.not_modified and handler.headers.get("If-None-Match"):
+				self.respond(handler, 304, b"", headers)
+				return
+
+		self.respond(handler, 200, body, headers)
+
+
+	def respond(self, handler, status, body, headers={}):
+
+		handler.send_response(status)
+		for key, value in headers.items():
+			handler.send_header(key, value)
+		handler.send_header("Content-Length", str(len(body)))
+		handler.end_headers()
+		handler.wfile.write(body)
+
+
+
+def make_features(count):
+
+	return [ {
+		'type': "Feature",
+		'properties': { 'OBJECTID': i + 1, 'naturvernId': "VV%08i" % (i + 1) },
+		'geometry': { 'type': "Polygon", 'coordinates': [ [ [10 + i * 0.01, 60], [10 + i * 0.01, 60.01], [10.005 + i * 0.01, 60], [10 + i * 0.01, 60] ] ] }
+	} for i in range(count) ]
+
+
+
+@pytest.fixture
+def arcgis_server():
+
+	server = ArcGISServer(make_features(23))
+	yield server
+	server.http_server.shutdown()
+	server.http_server.server_close()
+
+
+
+# Download settings for tests: short pages, no waiting between retries, cache in temporary folder
+
+@pytest.fixture
+def download_settings(monkeypatch, tmp_path):
+
+	import reserve2osm
+
+	monkeypatch.setattr(reserve2osm, "page_size", 5)
+	monkeypatch.setattr(reserve2osm, "retry_delay", 0.001)
+	monkeypatch.setattr(reserve2osm, "download_retries", 3)
+	monkeypatch.setattr(reserve2osm, "cache_folder", str(tmp_path / "cache"))
+	reserve2osm.http_connections.__dict__.clear()  # No connections to servers of earlier tests
+
+	return reserve2osm
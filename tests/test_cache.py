@@ -0,0 +1,90 @@
+# Tests of the cache of downloaded pages, with a local stand-in for the Naturbase REST server
+
+import json
+import os
+
+import pytest
+
+
+
+def cache_entries(reserve2osm):
+
+	entries = []
+	for filename in sorted(os.listdir(reserve2osm.cache_folder)):
+		file = open(os.path.join(reserve2osm.cache_folder, filename), encoding="utf-8")
+		entries.append(json.load(file))
+		file.close()
+
+	return entries
+
+
+
+def test_revalidation(arcgis_server, download_settings):
+
+	url = arcgis_server.url + "query?where=1=1&returnCountOnly=true&f=json"
+
+	assert download_settings.get_json(url) == { 'count': 23 }
+	entry = download_settings.read_cache(url)
+	assert entry['etag'] and entry['last_modified'] and entry['data'] == { 'count': 23 }
+
+	assert download_settings.get_json(url) == { 'count': 23 }
+	path, headers = arcgis_server.requests[-1]
+	assert headers['If-None-Match'] == entry['etag']
+	assert headers['If-Modified-Since'] == entry['last_modified']
+
+
+
+def test_not_modified_uses_cached_body(arcgis_server, download_settings):
+
+	url = arcgis_server.url + "query?where=1=1&returnCountOnly=true&f=json"
+	download_settings.get_json(url)
+
+	# Server still answers 304, so the cached body is used
+	del arcgis_server.features[5:]
+	arcgis_server.not_modified = True
+	assert download_settings.get_json(url) == { 'count': 23 }
+
+	# Changed response replaces cache entry
+	arcgis_server.not_modified = False
+	assert download_settings.get_json(url) == { 'count': 5 }
+	assert download_settings.read_cache(url)['data'] == { 'count': 5 }
+
+
+
+def test_no_validators(arcgis_server, download_settings):
+
+	arcgis_server.etag = False
+	url = arcgis_server.url + "query?where=1=1&returnCountOnly=true&f=json"
+
+	download_settings.get_json(url)
+	download_settings.get_json(url)
+
+	path, headers = arcgis_server.requests[-1]
+	assert "If-None-Match" not in headers and "If-Modified-Since" not in headers
+
+
+
+def test_offline(arcgis_server, download_settings):
+
+	features = download_settings.load_query(arcgis_server.url, "1=1")
+	request_count = len(arcgis_server.requests)
+
+	assert download_settings.load_query(arcgis_server.url, "1=1", offline=True) == features
+	assert len(arcgis_server.requests) == request_count
+
+	with pytest.raises(SystemExit):
+		download_settings.get_json(arcgis_server.url + "query?where=missing&f=json", offline=True)
+	assert len(arcgis_server.requests) == request_count
+
+
+
+def test_incremental_queries_not_cached(arcgis_server, download_settings, tmp_path):
+
+	store_filename = str(tmp_path / "naturvern_features.sqlite")
+
+	download_settings.update_store(arcgis_server.url, store_filename, "naturvern", {}, incremental=True)
+	entries = cache_entries(download_settings)
+
+	download_settings.update_store(arcgis_server.url, store_filename, "naturvern", {}, incremental=True)
+	assert any("timestamp" in query.get('where', [""])[0] for query in arcgis_server.queries("where"))
+	assert cache_entries(download_settings) == entries
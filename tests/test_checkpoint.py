@@ -0,0 +1,91 @@
+# Tests of saving and resuming from checkpoint files, and of reusing components with --incremental
+
+import contextlib
+import io
+import pickle
+
+import reserve2osm
+import benchmark
+
+
+
+def run(function, *args):
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		return function(*args)
+
+
+
+# Packed topology, with parents of ways as sets
+
+def topology(converter):
+
+	data = reserve2osm.pack_topology(converter.ways, converter.areas)
+	data['way_parents'] = [ parents and set(parents) for parents in data['way_parents'] ]
+	return data
+
+
+
+def new_converter():
+
+	converter = reserve2osm.Converter("test.geojson")
+	converter.features = benchmark.generate_features(10, 1)
+	return converter
+
+
+
+def test_resume(tmp_path):
+
+	converter = new_converter()
+	run(converter.build)
+	run(converter.save_checkpoint, str(tmp_path / "test.checkpoint"))
+
+	resumed = reserve2osm.Converter("test.geojson")
+	assert run(resumed.load_checkpoint, str(tmp_path / "test.checkpoint"))
+	assert topology(resumed) == topology(converter)
+
+	outputs = []
+	for stages in [ converter, resumed ]:
+		run(stages.combine)
+		run(stages.simplify)
+		run(stages.write, str(tmp_path / "test.osm"))
+		file = open(tmp_path / "test.osm", "rb")
+		outputs.append(file.read())
+		file.close()
+
+	assert outputs[0] == outputs[1]
+
+
+
+def test_other_format_not_loaded(tmp_path):
+
+	file = open(tmp_path / "test.checkpoint", "wb")
+	file.write(pickle.dumps({ 'version': reserve2osm.version }))
+	file.close()
+
+	converter = reserve2osm.Converter("test.geojson")
+	assert reserve2osm.load_checkpoint_file(str(tmp_path / "test.checkpoint")) is None
+	assert not run(converter.load_checkpoint, str(tmp_path / "test.checkpoint"))
+
+
+
+# Reused components of --incremental must give the same output as building all components
+
+def test_incremental_settings_changed(tmp_path, monkeypatch):
+
+	monkeypatch.chdir(tmp_path)
+
+	outputs = []
+	for incremental, debug in [ (True, False), (True, True), (False, True) ]:
+		converter = reserve2osm.Converter("test.geojson", jobs=2, debug=debug, incremental=incremental)
+		converter.features = benchmark.generate_features(10, 1)
+		run(converter.build)
+		run(converter.combine)
+		run(converter.simplify)
+		run(converter.write, "test.osm")
+		file = open("test.osm", "rb")
+		outputs.append(file.read())
+		file.close()
+
+	assert b"KOMBINERT" in outputs[2]
+	assert outputs[1] == outputs[2]
@@ -0,0 +1,130 @@
+# Tests of loading features from a local stand-in for the Naturbase REST server
+
+import contextlib
+import io
+
+import pytest
+
+
+
+def test_count_query(arcgis_server, download_settings):
+
+	features = download_settings.load_query(arcgis_server.url, "1=1")
+
+	count_queries = arcgis_server.queries("returnCountOnly")
+	assert len(count_queries) == 1
+	assert count_queries[0]['where'] == [ "1=1" ]
+	assert features == arcgis_server.features
+
+
+
+def test_limit(arcgis_server, download_settings):
+
+	features = download_settings.load_query(arcgis_server.url, "1=1", limit=10)
+
+	assert features == arcgis_server.features[:10]
+
+
+
+def test_pages_in_offset_order(arcgis_server, download_settings):
+
+	# Later pages are returned first
+	arcgis_server.delay = lambda query: 0.2 - int(query['resultOffset'][0]) / 200 if "resultOffset" in query else 0
+
+	features = download_settings.load_query(arcgis_server.url, "1=1")
+
+	assert len(arcgis_server.queries("resultOffset")) == 5
+	assert features == arcgis_server.features
+
+
+
+def test_short_pages(arcgis_server, download_settings):
+
+	arcgis_server.max_records = 2  # Server returns less than page size
+
+	features = download_settings.load_page(arcgis_server.url + "query?where=1=1&outFields=*&f=geojson", 5)
+
+	assert features == arcgis_server.features[5:10]
+	assert [ (query['resultOffset'][0], query['resultRecordCount'][0]) for query in arcgis_server.queries("resultOffset") ] \
+			== [ ("5", "5"), ("7", "3"), ("9", "1") ]
+
+
+
+def test_last_short_page(arcgis_server, download_settings):
+
+	arcgis_server.max_records = 2
+
+	features = download_settings.load_page(arcgis_server.url + "query?where=1=1&outFields=*&f=geojson", 20)
+
+	assert features == arcgis_server.features[20:]
+
+
+
+@pytest.mark.parametrize("failures", [ ["500"], ["drop"], ["500", "drop", "500"] ])
+def test_retry(arcgis_server, download_settings, failures):
+
+	arcgis_server.failures = list(failures)
+
+	data = download_settings.get_json(arcgis_server.url + "query?where=1=1&returnCountOnly=true&f=json")
+
+	assert data == { 'count': 23 }
+	assert len(arcgis_server.requests) == len(failures) + 1
+
+
+
+def test_retry_pages(arcgis_server, download_settings):
+
+	arcgis_server.failures = [ None, "500", None, "drop", "500" ]
+
+	features = download_settings.load_query(arcgis_server.url, "1=1")
+
+	assert features == arcgis_server.features
+
+
+
+def test_retries_exhausted(arcgis_server, download_settings):
+
+	arcgis_server.failures = [ "500" ] * 10
+
+	with pytest.raises(SystemExit):
+		download_settings.get_json(arcgis_server.url + "query?where=1=1&returnCountOnly=true&f=json")
+
+	assert len(arcgis_server.requests) == download_settings.download_retries + 1
+
+
+
+@pytest.mark.parametrize("field", [ "kommune", "verneform" ])
+def test_selection_not_in_friluft(arcgis_server, download_settings, monkeypatch, field):
+
+	monkeypatch.setitem(download_settings.endpoints, "friluft", arcgis_server.url)
+
+	with pytest.raises(SystemExit):
+		download_settings.load_data("friluft", { field: [ "5001" ] })
+
+	assert arcgis_server.requests == []
+
+
+
+def test_selection_not_changed(arcgis_server, download_settings, monkeypatch, tmp_path):
+
+	monkeypatch.chdir(tmp_path)  # Feature store in temporary folder
+	monkeypatch.setitem(download_settings.endpoints, "naturvern", arcgis_server.url)
+	selection = { 'where': "verneplan = 'Skogvern'" }
+
+	converter = download_settings.Converter("naturvern", selection=selection)
+	with contextlib.redirect_stdout(io.StringIO()):
+		converter.load()
+
+	assert selection == { 'where': "verneplan = 'Skogvern'" }
+	assert converter.object_ids == set(range(1, 24))
+	assert len(list(converter.features)) == 23
+
+	# Offline converter with other selection uses feature store only, without object ids of the first converter
+	request_count = len(arcgis_server.requests)
+	offline_converter = download_settings.Converter("naturvern", selection={ 'bbox': [ 9, 59, 11, 61 ] }, offline=True)
+	with contextlib.redirect_stdout(io.StringIO()):
+		offline_converter.load()
+
+	assert offline_converter.object_ids is None
+	assert len(list(offline_converter.features)) == 23
+	assert len(arcgis_server.requests) == request_count
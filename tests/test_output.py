@@ -0,0 +1,255 @@
+# Round-trip tests of OSM output formats: PBF is decoded and compared with the OSM XML file,
+# and compressed XML files are compared with the plain XML file. Also tests ids of elements with stable ids.
+
+import bz2
+import contextlib
+import gzip
+import io
+import struct
+import xml.etree.ElementTree as ET
+import zlib
+
+import pytest
+
+import reserve2osm
+import benchmark
+
+
+
+# Decode protobuf message into list of (field number, value), with bytes for length-delimited fields
+
+def decode_message(data):
+
+	fields = []
+	i = 0
+	while i < len(data):
+		key, i = decode_varint(data, i)
+		number, wire_type = key >> 3, key & 7
+		if wire_type == 0:
+			value, i = decode_varint(data, i)
+		elif wire_type == 2:
+			length, i = decode_varint(data, i)
+			value = data[i : i + length]
+			i += length
+		else:
+			raise ValueError("Unexpected wire type %i" % wire_type)
+		fields.append((number, value))
+
+	return fields
+
+
+
+def decode_varint(data, i):
+
+	value = 0
+	shift = 0
+	while True:
+		byte = data[i]
+		i += 1
+		value |= (byte & 0x7F) << shift
+		shift += 7
+		if byte < 0x80:
+			return (value, i)
+
+
+
+def signed(value):  # int64 two's complement
+
+	return value - (1 << 64) if value >= 1 << 63 else value
+
+
+
+def zigzag(value):  # sint64
+
+	return (value >> 1) ^ -(value & 1)
+
+
+
+def packed(data, convert=lambda value: value, delta=False):
+
+	values = []
+	i = 0
+	last = 0
+	while i < len(data):
+		value, i = decode_varint(data, i)
+		value = convert(value)
+		if delta:
+			value += last
+			last = value
+		values.append(value)
+
+	return values
+
+
+
+# Decode OSM PBF file into lists of nodes (id, lon, lat), ways (id, refs, tags) and relations (id, members, tags),
+# with coordinates in 1e-7 degrees
+
+def decode_pbf(filename):
+
+	file = open(filename, "rb")
+	data = file.read()
+	file.close()
+
+	nodes, ways, relations = [], [], []
+	block_types = []
+	i = 0
+
+	while i < len(data):
+		header_length = struct.unpack(">I", data[i : i + 4])[0]
+		header = dict(decode_message(data[i + 4 : i + 4 + header_length]))
+		i += 4 + header_length
+		blob = dict(decode_message(data[i : i + header[3]]))
+		i += header[3]
+
+		block = zlib.decompress(blob[3]) if 3 in blob else blob[1]
+		assert 2 not in blob or len(block) == blob[2]
+		block_types.append(header[1].decode())
+
+		if header[1] == b"OSMHeader":
+			features = [ value for number, value in decode_message(block) if number == 4 ]
+			assert b"OsmSchema-V0.6" in features and b"DenseNodes" in features
+			continue
+
+		block_fields = decode_message(block)
+		strings = [ value.decode() for number, value in decode_message(dict(block_fields)[1]) if number == 1 ]
+		assert strings[0] == ""
+
+		for number, group in block_fields:
+			if number != 2:
+				continue
+			for group_type, entity in decode_message(group):
+				fields = decode_message(entity)
+				values = {}
+				for field_number, value in fields:
+					values[ field_number ] = value
+
+				if group_type == 2:  # Dense nodes
+					ids = packed(values[1], zigzag, delta=True)
+					lats = packed(values[8], zigzag, delta=True)
+					lons = packed(values[9], zigzag, delta=True)
+					nodes.extend(zip(ids, lons, lats))
+
+				else:
+					tags = list(zip([ strings[ key ] for key in packed(values.get(2, b"")) ],
+									[ strings[ value ] for value in packed(values.get(3, b"")) ]))
+					if group_type == 3:
+						ways.append((signed(values[1]), packed(values[8], zigzag, delta=True), tags))
+					else:
+						assert group_type == 4
+						roles = [ strings[ role ] for role in packed(values[8]) ]
+						member_ids = packed(values[9], zigzag, delta=True)
+						assert packed(values[10]) == [ 1 ] * len(member_ids)  # Way members
+						relations.append((signed(values[1]), list(zip(member_ids, roles)), tags))
+
+	return (nodes, ways, relations, block_types)
+
+
+
+# Decode OSM XML file into the same lists as decode_pbf
+
+def decode_xml(filename):
+
+	root = ET.parse(filename).getroot()
+
+	nodes = [ (int(node.get("id")), round(float(node.get("lon")) * 10000000), round(float(node.get("lat")) * 10000000))
+				for node in root.iter("node") ]
+	ways = [ (int(way.get("id")), [ int(nd.get("ref")) for nd in way.iter("nd") ],
+				[ (tag.get("k"), tag.get("v")) for tag in way.iter("tag") ]) for way in root.iter("way") ]
+	relations = []
+	for relation in root.iter("relation"):
+		members = []
+		for member in relation.iter("member"):
+			assert member.get("type") == "way"
+			members.append((int(member.get("ref")), member.get("role")))
+		relations.append((int(relation.get("id")), members, [ (tag.get("k"), tag.get("v")) for tag in relation.iter("tag") ]))
+
+	return (nodes, ways, relations)
+
+
+
+# Convert synthetic areas once, with more than 8000 nodes to get several PBF blocks
+
+@pytest.fixture(scope="module")
+def converter():
+
+	converter = reserve2osm.Converter("test.geojson")
+	converter.features = benchmark.generate_features(20, 1)
+	with contextlib.redirect_stdout(io.StringIO()):
+		converter.build()
+		converter.combine()
+		converter.simplify()
+
+	return converter
+
+
+
+def write(converter, filename):
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		converter.write(str(filename))
+
+
+
+def test_pbf_round_trip(converter, tmp_path):
+
+	write(converter, tmp_path / "test.osm")
+	write(converter, tmp_path / "test.osm.pbf")
+
+	nodes, ways, relations = decode_xml(tmp_path / "test.osm")
+	pbf_nodes, pbf_ways, pbf_relations, block_types = decode_pbf(tmp_path / "test.osm.pbf")
+
+	assert len(nodes) > 8000 and ways and relations
+	assert any(tags for way_id, refs, tags in ways) or any(tags for relation_id, members, tags in relations)
+	assert block_types[0] == "OSMHeader" and block_types.count("OSMData") > 2
+
+	assert pbf_nodes == nodes
+	assert pbf_ways == ways
+	assert pbf_relations == relations
+
+
+
+@pytest.mark.parametrize("extension, module", [ (".gz", gzip), (".bz2", bz2) ])
+def test_compressed_xml(converter, tmp_path, extension, module):
+
+	write(converter, tmp_path / "test.osm")
+	write(converter, tmp_path / ("test.osm" + extension))
+
+	file = open(tmp_path / "test.osm", "rb")
+	plain = file.read()
+	file.close()
+
+	file = module.open(tmp_path / ("test.osm" + extension), "rb")
+	decompressed = file.read()
+	file.close()
+
+	assert decompressed == plain
+
+
+
+def test_stable_ids(converter, tmp_path, monkeypatch):
+
+	monkeypatch.setattr(reserve2osm, "stable_ids", True)  # Module setting is only the command line default
+	write(converter, tmp_path / "counted.osm")
+
+	monkeypatch.setattr(converter, "stable_ids", True)
+	write(converter, tmp_path / "stable.osm")
+	with contextlib.redirect_stdout(io.StringIO()):
+		converter.write_diff(str(tmp_path / "test.osc"), { 'node': {}, 'way': {}, 'relation': {} })
+
+	nodes, ways, relations = decode_xml(tmp_path / "counted.osm")
+	stable_nodes, stable_ways, stable_relations = decode_xml(tmp_path / "stable.osm")
+	counted_ids = set(range(-1001, -1001 - len(nodes) - len(ways) - len(relations), -1))  # Counted down for all element types
+	assert { node_id for node_id, lon, lat in nodes } <= counted_ids
+	assert not { node_id for node_id, lon, lat in stable_nodes } <= counted_ids
+	assert [ (lon, lat) for node_id, lon, lat in stable_nodes ] == [ (lon, lat) for node_id, lon, lat in nodes ]
+	assert all(node_id < 0 for node_id, lon, lat in stable_nodes)
+
+	created_ids = { int(element.get("id")) for element in ET.parse(tmp_path / "test.osc").getroot().iter("node") }
+	assert created_ids == { node_id for node_id, lon, lat in stable_nodes }
+
+
+
+def test_generated_ways_combined(converter):
+
+	assert converter.combined_count > 0  # Synthetic areas cover combine stage in benchmark